@@ -1 +1,8 @@
-WORKERS_RANGE_OF_ACTION = 2.5
\ No newline at end of file
+WORKERS_RANGE_OF_ACTION = 2.5
+
+# Half duration of the window of PlotWorkerPipeline.smooth_df
+SMOOTHING_HALF_WINDOW = '10min'
+
+# Decoded masks cache of legacy zones without 'bits' (see utils.MaskCache)
+MASK_CACHE_MAX_BYTES = 512 * 1024**2
+MASK_CACHE_FOLDER = None
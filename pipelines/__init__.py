@@ -2,6 +2,7 @@ from .json_preprocessing import JsonPreprocessingPipeline
 from .json_preprocessing_analytics import JsonPreprocessingAnalyticsPipeline
 from .concrete_pump import ConcretePumpPipeline
 from .working_workers import WorkingWorkersPipeline
+from .zone_occupancy import ZoneOccupancyPipeline
 from .plot_worker import PlotWorkerPipeline
 from .plot_heatmap import PlotHeatmapPipeline
 
@@ -10,6 +11,7 @@ pipelines = [
     JsonPreprocessingAnalyticsPipeline,
     ConcretePumpPipeline,
     WorkingWorkersPipeline,
+    ZoneOccupancyPipeline,
     PlotWorkerPipeline,
     PlotHeatmapPipeline,
 ]
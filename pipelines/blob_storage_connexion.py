@@ -1,46 +1,194 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
-
-from azure.storage.blob import ContainerClient
-
-from credentials.blob_credentials import facts_container, facts_sas_token
+from typing import Callable, List, Tuple
 
 
 class BlobStorageConnexionPipeline:
-    
+
     def launch(self,
-               account_url: str = "https://hecdf.blob.core.windows.net"
+               account_url: str = "https://hecdf.blob.core.windows.net",
+               max_workers: int = 8,
+               retries: int = 3,
+               chunk_size: int = 4 * 1024 * 1024,
+               sync: bool = True,
+               on_downloaded: Callable[[str], None] = None,
+               container_client=None,
+               backoff: float = 1.
               ) -> None:
+        """
+        container_client replaces the client of the Azure container, e.g.
+        with pipelines.fake_container_client.FakeContainerClient.
+        """
         print('BlobStorageConnexion launched')
-        facts_blob_service = self.extract(account_url)
+        facts_blob_service = (
+            self.extract(account_url, chunk_size)
+            if container_client is None else container_client
+        )
         blobs = self.transform(facts_blob_service)
-        self.load(facts_blob_service, blobs)
+        manifest = self._read_manifest() if sync else {}
+        new_blobs, removed = self._get_delta(blobs, manifest)
+        print(f'{len(new_blobs)} new or changed blobs, {len(removed)} removed')
+        for file_name in removed:
+            print('removed upstream:', file_name)
+        downloaded = self.load(facts_blob_service, new_blobs,
+                               max_workers, retries, on_downloaded, backoff)
+        self._write_manifest(manifest, new_blobs, downloaded, removed)
         print('BlobStorageConnexion ended\n')
-    
+
     @staticmethod
-    def extract(account_url: str):
+    def extract(account_url: str, chunk_size: int = 4 * 1024 * 1024):
+        # Imported here, so that the pipeline runs on a fake client without
+        # the Azure SDK and the credentials
+        from azure.storage.blob import ContainerClient
+
+        from credentials.blob_credentials import (facts_container,
+                                                  facts_sas_token)
+
         return ContainerClient(account_url=account_url,
                                container_name=facts_container,
-                               credential=facts_sas_token)
-    
+                               credential=facts_sas_token,
+                               max_single_get_size=chunk_size,
+                               max_chunk_get_size=chunk_size)
+
     @staticmethod
     def transform(facts_blob_service) -> List[str]:
         return list(facts_blob_service.list_blobs())
-    
+
+    @classmethod
+    def load(cls,
+             facts_blob_service,
+             blobs: List[str],
+             max_workers: int = 8,
+             retries: int = 3,
+             on_downloaded: Callable[[str], None] = None,
+             backoff: float = 1.) -> List[str]:
+        """
+        Downloads the blobs with a bounded pool of threads. Each blob is
+        streamed to disk chunk by chunk, so that memory usage does not
+        depend on the size of the blobs. If given, on_downloaded is called
+        with the name of each blob as soon as it is on disk.
+
+        Returns
+        -------
+        downloaded: list
+            names of the blobs successfully downloaded
+        """
+        downloaded = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(cls._download_blob, facts_blob_service,
+                                blob.name, retries, backoff): blob.name
+                for blob in blobs
+            }
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    future.result()
+                except Exception as error:
+                    print('download failed for', file_name, error)
+                    continue
+                downloaded.append(file_name)
+                if on_downloaded is not None:
+                    on_downloaded(file_name)
+
+        return downloaded
+
+    ##################
+    # Helper methods #
+    ##################
+
     @staticmethod
-    def load(facts_blob_service, blobs: List[str]) -> None:
+    def _read_manifest(
+        manifest_file: str = 'intermediate_process/blob_manifest.json'
+    ) -> dict:
+        if not os.path.isfile(manifest_file):
+            return {}
+        with open(manifest_file) as file:
+            return json.load(file)
+
+    @staticmethod
+    def _write_manifest(
+        manifest: dict,
+        blobs: list,
+        downloaded: List[str],
+        removed: List[str],
+        manifest_file: str = 'intermediate_process/blob_manifest.json'
+    ) -> None:
+        downloaded = set(downloaded)
+        for blob in blobs:
+            if blob.name in downloaded:
+                manifest[blob.name] = {
+                    'etag': blob.etag,
+                    'size': blob.size,
+                    'last_modified': str(blob.last_modified),
+                }
+        for file_name in removed:
+            manifest[file_name]['removed'] = True
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+        with open(manifest_file, 'w') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+
+    @staticmethod
+    def _get_delta(blobs: list, manifest: dict) -> Tuple[list, List[str]]:
+        """
+        Compares the listing of the container to the manifest of the
+        previous runs.
+
+        Returns
+        -------
+        new_blobs: list
+            blobs that are new, have changed upstream or are missing locally
+        removed: list
+            names of the blobs of the manifest no longer in the container
+        """
+        new_blobs = []
         for blob in blobs:
-            file_name = blob.name
-            download_stream = (
-                facts_blob_service
-                .get_blob_client(file_name)
-                .download_blob()
-            )
-            Path(f'./{file_name}').parent.mkdir(parents=True, exist_ok=True)
-            with open(f"./{file_name}", "wb") as data:
-                data.write(download_stream.readall())
-
-                
+            entry = manifest.get(blob.name)
+            if (entry is None
+                    or entry.get('removed')
+                    or entry['etag'] != blob.etag
+                    or entry['size'] != blob.size
+                    or entry['last_modified'] != str(blob.last_modified)
+                    or not os.path.isfile(f'./{blob.name}')):
+                new_blobs.append(blob)
+        listed = {blob.name for blob in blobs}
+        removed = [
+            file_name for file_name, entry in manifest.items()
+            if file_name not in listed and not entry.get('removed')
+        ]
+
+        return new_blobs, removed
+
+    @staticmethod
+    def _download_blob(facts_blob_service,
+                       file_name: str,
+                       retries: int,
+                       backoff: float = 1.) -> None:
+        path = Path(f'./{file_name}')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = path.with_name(path.name + '.part')
+        for attempt in range(retries + 1):
+            try:
+                download_stream = (
+                    facts_blob_service
+                    .get_blob_client(file_name)
+                    .download_blob()
+                )
+                with open(part_path, 'wb') as data:
+                    for chunk in download_stream.chunks():
+                        data.write(chunk)
+                os.replace(part_path, path)
+                return
+            except Exception:
+                if attempt == retries:
+                    if part_path.exists():
+                        part_path.unlink()
+                    raise
+                time.sleep(backoff * 2**attempt)
+
+
 if __name__ == '__main__':
     BlobStorageConnexionPipeline().launch()
-
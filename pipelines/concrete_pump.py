@@ -1,21 +1,30 @@
 import os
 import pickle
-from typing import List, Tuple
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
-from shapely.geometry import Polygon
 
-from utils import draw_mask
+from utils import PolygonZones, draw_cropped_mask, parallel_map
 
 
 class ConcretePumpPipeline:
+    # Artifacts read and written, see project.Project
+    inputs = [
+        'intermediate_process/zones_processed.pickle',
+    ]
+    outputs = [
+        'intermediate_process/pump_key_points.pickle',
+    ]
 
     def launch(self,
-               analytics_pattern: str = 'Analytics'
+               analytics_pattern: str = 'Analytics',
+               n_jobs: int = 1,
+               chunk_size: int = 16
                ) -> None:
         print('ConcretePump launched')
         zones = self.extract()
-        pump_by_picture = self.transform(zones, analytics_pattern)
+        pump_by_picture = self.transform(zones, analytics_pattern,
+                                         n_jobs, chunk_size)
         self.load(pump_by_picture)
         print('ConcretePump ended\n')
     
@@ -27,22 +36,25 @@ class ConcretePumpPipeline:
         return zones_processed
     
     @classmethod
-    def transform(cls, zones: dict, analytics_pattern: str) -> dict:
-        pump_by_picture = {}
-        for picture in zones:
-            if not picture.startswith(analytics_pattern):
-                continue
-            zones_by_type, height, width = zones[picture]
-            extremities = []
-            centroids = []
-            for pump in zones_by_type['Concrete_pump_hose']:
-                mask = draw_mask(pump, height, width)
-                extremities.append(cls._get_pump_extremity(mask))
-                centroids.append(cls._get_pump_centroid(mask))
-            pump_by_picture[picture] = {'extremity': extremities,
-                                        'centroid': centroids}
+    def transform(cls,
+                  zones: dict,
+                  analytics_pattern: str,
+                  n_jobs: int = 1,
+                  chunk_size: int = 16) -> dict:
+        pictures = [
+            picture for picture in zones
+            if picture.startswith(analytics_pattern)
+        ]
+        key_points = parallel_map(
+            cls._get_pumps_key_points,
+            [zones[picture][0]['Concrete_pump_hose'] for picture in pictures],
+            [zones[picture][1] for picture in pictures],
+            [zones[picture][2] for picture in pictures],
+            n_jobs=n_jobs,
+            chunk_size=chunk_size
+        )
         
-        return pump_by_picture
+        return dict(zip(pictures, key_points))
     
     @staticmethod
     def load(pump_by_picture: dict) -> None:
@@ -54,23 +66,67 @@ class ConcretePumpPipeline:
     # Helper methods #
     ##################
 
-    @staticmethod
-    def _get_pump_extremity(mask: np.array) -> Tuple[int]:
-        last_index = len(mask)-1
-        while sum(mask[last_index])==0 and last_index>=0:
-            last_index-=1
-        if last_index == -1:
-            return (None, None)
-        
-        one_mask = mask[last_index]*range(len(mask[last_index]))
-        return (int(round(one_mask[one_mask>0].mean())), last_index)
+    @classmethod
+    def _get_pumps_key_points(cls,
+                              pumps: List[Union[dict, list]],
+                              height: int,
+                              width: int) -> Dict[str, list]:
+        """
+        Computes the key points of all the pumps of a picture. Polygon
+        pumps are handled as vector geometries, bitmap pumps are drawn on
+        their bounding box only.
+
+        Returns
+        -------
+        key_points: dict
+            'extremity', 'centroid', 'bbox' and 'area' of each pump
+        """
+        polygons = PolygonZones([pump for pump in pumps if type(pump) is list])
+        polygon_index = 0
+        key_points = {'extremity': [], 'centroid': [], 'bbox': [], 'area': []}
+        for pump in pumps:
+            if type(pump) is list:
+                pump_key_points = polygons.get_key_points(polygon_index,
+                                                         height, width)
+                polygon_index += 1
+            else:
+                pump_key_points = cls._get_pump_key_points(
+                    *draw_cropped_mask(pump, height, width)
+                )
+            for key, value in pump_key_points.items():
+                key_points[key].append(value)
+
+        return key_points
 
     @staticmethod
-    def _get_pump_centroid(mask: np.array) -> Tuple[float]:
-        if (mask==1).sum() == 0:
-            return (None, None)
-        
-        return np.argwhere(mask==1).sum(0)/(mask==1).sum()
+    def _get_pump_key_points(mask: np.array,
+                             origin: Tuple[int] = (0, 0)) -> dict:
+        """
+        Computes in a single pass over the pixels of a pump mask:
+        - extremity: (x, y) of the middle of the lowest row of the pump
+        - centroid: (row, column) of the centroid of the pump
+        - bbox: [x_min, y_min, x_max, y_max] of the pump
+        - area: number of pixels of the pump
+        Coordinates are in the frame, mask being placed at origin.
+        """
+        rows, cols = np.nonzero(mask)
+        if len(rows) == 0:
+            return {'extremity': (None, None), 'centroid': (None, None),
+                    'bbox': None, 'area': 0}
+        rows = rows + origin[1]
+        cols = cols + origin[0]
+        # np.nonzero sorts pixels by row: the lowest row comes last
+        last_row = rows[-1]
+        last_row_cols = cols[np.searchsorted(rows, last_row):]
+        area = len(rows)
+
+        return {
+            'extremity': (int(round(last_row_cols.mean())), int(last_row)),
+            'centroid': np.array([rows.sum(), cols.sum()]) / area,
+            'bbox': [int(cols.min()), int(rows[0]),
+                     int(cols.max()), int(last_row)],
+            'area': area,
+        }
 
 if __name__=='__main__':
     ConcretePumpPipeline().launch()
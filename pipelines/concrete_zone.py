@@ -1,15 +1,16 @@
 import os
 import pickle
 
-from utils import draw_mask
+from stores import MaskStore
+from utils import compress_mask, draw_cropped_mask, parallel_map
 
 
 class ConcreteZonePipeline:
 
-    def launch(self) -> None:
+    def launch(self, n_jobs: int = 1, chunk_size: int = 16) -> None:
         print('ConcreteZone launched')
         zones = self.extract()
-        masks = self.transform(zones)
+        masks = self.transform(zones, n_jobs, chunk_size)
         self.load(masks)
         print('ConcreteZone ended\n')
     
@@ -21,25 +22,40 @@ class ConcreteZonePipeline:
         return zones_processed
     
     @classmethod
-    def transform(cls, zones: dict) -> dict:
-        mask_by_picture = {}
-        for picture in zones.keys():
-            masks_by_type = {}
-            zones_by_type, height, width = zones[picture]
-            for zone_type in zones_by_type.keys():
-                masks = []
-                for zone in zones_by_type[zone_type]:
-                    masks.append(draw_mask(zone, height, width))
-                masks_by_type[zone_type] = masks
-            mask_by_picture[picture] = (masks_by_type, height, width)
+    def transform(cls,
+                  zones: dict,
+                  n_jobs: int = 1,
+                  chunk_size: int = 16) -> dict:
+        pictures = list(zones.keys())
+        masks = parallel_map(cls._get_masks_by_type,
+                             [zones[picture] for picture in pictures],
+                             n_jobs=n_jobs,
+                             chunk_size=chunk_size)
         
-        return mask_by_picture
+        return dict(zip(pictures, masks))
 
     @staticmethod
     def load(masks: dict) -> None:
         os.makedirs('intermediate_process', exist_ok=True)
-        with open('intermediate_process/masks.pickle', 'wb') as f:
-            pickle.dump(masks, f, protocol=pickle.HIGHEST_PROTOCOL)
+        MaskStore.save(masks, folder='intermediate_process/mask_store')
+
+    ##################
+    # Helper methods #
+    ##################
+
+    @staticmethod
+    def _get_masks_by_type(zones_of_picture: tuple) -> tuple:
+        zones_by_type, height, width = zones_of_picture
+        masks_by_type = {}
+        for zone_type in zones_by_type.keys():
+            masks = []
+            for zone in zones_by_type[zone_type]:
+                masks.append(compress_mask(
+                    *draw_cropped_mask(zone, height, width)
+                ))
+            masks_by_type[zone_type] = masks
+
+        return (masks_by_type, height, width)
 
 if __name__=='__main__':
     ConcreteZonePipeline().launch()
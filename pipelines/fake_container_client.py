@@ -0,0 +1,136 @@
+import hashlib
+import os
+import tempfile
+import threading
+from datetime import datetime
+from typing import Dict, Iterator
+
+from .blob_storage_connexion import BlobStorageConnexionPipeline
+
+
+class FakeBlobProperties:
+    def __init__(self, name: str, data: bytes, last_modified: datetime):
+        self.name = name
+        self.etag = hashlib.md5(data).hexdigest()
+        self.size = len(data)
+        self.last_modified = last_modified
+
+
+class FakeContainerClient:
+    """
+    In-memory stand-in for azure.storage.blob.ContainerClient, with the
+    methods used by BlobStorageConnexionPipeline, to run the pipeline
+    without a storage account.
+
+    Parameters
+    ----------
+    blobs: dict
+        content of each blob, by name
+    failures: dict
+        number of downloads of a blob that fail after its first chunk
+    chunk_size: int
+        size of the chunks of the downloads
+    """
+
+    def __init__(self,
+                 blobs: Dict[str, bytes],
+                 failures: Dict[str, int] = None,
+                 chunk_size: int = 4):
+        self.blobs = {}
+        self.properties = {}
+        self.failures = dict(failures or {})
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        for name, data in blobs.items():
+            self.upload_blob(name, data)
+
+    def upload_blob(self, name: str, data: bytes) -> None:
+        self.blobs[name] = data
+        self.properties[name] = FakeBlobProperties(name, data, datetime.now())
+
+    def delete_blob(self, name: str) -> None:
+        del self.blobs[name]
+        del self.properties[name]
+
+    def list_blobs(self) -> Iterator[FakeBlobProperties]:
+        return iter([self.properties[name] for name in sorted(self.blobs)])
+
+    def get_blob_client(self, name: str) -> 'FakeBlobClient':
+        return FakeBlobClient(self, name)
+
+
+class FakeBlobClient:
+    def __init__(self, container: FakeContainerClient, name: str):
+        self.container = container
+        self.name = name
+
+    def download_blob(self) -> 'FakeStorageStreamDownloader':
+        return FakeStorageStreamDownloader(self.container, self.name)
+
+
+class FakeStorageStreamDownloader:
+    def __init__(self, container: FakeContainerClient, name: str):
+        self.container = container
+        self.name = name
+
+    def chunks(self) -> Iterator[bytes]:
+        data = self.container.blobs[self.name]
+        size = self.container.chunk_size
+        for start in range(0, max(len(data), 1), size):
+            yield data[start:start+size]
+            with self.container.lock:
+                failing = self.container.failures.get(self.name, 0) > 0
+                if failing:
+                    self.container.failures[self.name] -= 1
+            if failing:
+                raise ConnectionError(f'download of {self.name} interrupted')
+
+
+def check() -> None:
+    """
+    Runs BlobStorageConnexionPipeline on a FakeContainerClient in a
+    temporary folder: interrupted downloads are retried, the .part files
+    of the failed ones are removed, and re-runs only download the new and
+    changed blobs.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            client = FakeContainerClient(
+                {'a/1.json': b'{"objects": []}', 'a/2.json': b'{}',
+                 'b/3.json': b'[1, 2, 3]'},
+                failures={'a/2.json': 1, 'b/3.json': 10}
+            )
+            pipeline = BlobStorageConnexionPipeline()
+            downloaded = []
+            pipeline.launch(container_client=client, retries=2, backoff=0,
+                            on_downloaded=downloaded.append)
+            assert sorted(downloaded) == ['a/1.json', 'a/2.json']
+            assert open('a/2.json', 'rb').read() == client.blobs['a/2.json']
+            assert not os.path.exists('b/3.json')
+            assert not os.path.exists('b/3.json.part')
+
+            # Only the failed, changed and new blobs are downloaded again
+            client.failures = {}
+            client.upload_blob('a/1.json', b'{"objects": [1]}')
+            client.upload_blob('c/4.json', b'{}')
+            client.delete_blob('a/2.json')
+            downloaded = []
+            pipeline.launch(container_client=client, backoff=0,
+                            on_downloaded=downloaded.append)
+            assert sorted(downloaded) == ['a/1.json', 'b/3.json', 'c/4.json']
+            manifest = pipeline._read_manifest()
+            assert manifest['a/2.json']['removed']
+
+            downloaded = []
+            pipeline.launch(container_client=client, backoff=0,
+                            on_downloaded=downloaded.append)
+            assert downloaded == []
+        finally:
+            os.chdir(cwd)
+    print('FakeContainerClient check passed')
+
+
+if __name__ == '__main__':
+    check()
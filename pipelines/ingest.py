@@ -0,0 +1,86 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import get_changed_files
+
+from .blob_storage_connexion import BlobStorageConnexionPipeline
+from .json_preprocessing_analytics import JsonPreprocessingAnalyticsPipeline
+
+
+class IngestPipeline:
+    """
+    Downloads the blobs and parses the annotation JSONs at the same time:
+    each JSON is handed to a pool of parsing processes as soon as it is
+    on disk, instead of waiting for the whole download to end.
+    """
+
+    def launch(self,
+               account_url: str = "https://hecdf.blob.core.windows.net",
+               max_workers: int = 8,
+               n_jobs: int = os.cpu_count(),
+               sync: bool = True,
+               container_client=None
+               ) -> None:
+        print('Ingest launched')
+        boxes_processed, zones_processed = (
+            JsonPreprocessingAnalyticsPipeline.extract_processed()
+        )
+        fingerprints = JsonPreprocessingAnalyticsPipeline.extract_fingerprints()
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = []
+            files = []
+
+            def on_downloaded(file_name: str) -> None:
+                if file_name.endswith('.json'):
+                    futures.append(executor.submit(
+                        JsonPreprocessingAnalyticsPipeline.process_json,
+                        file_name
+                    ))
+                    files.append(file_name)
+                elif file_name.endswith('.tar'):
+                    futures.append(executor.submit(
+                        JsonPreprocessingAnalyticsPipeline.process_archive,
+                        file_name
+                    ))
+                    files.append(file_name)
+
+            BlobStorageConnexionPipeline().launch(
+                account_url=account_url,
+                max_workers=max_workers,
+                sync=sync,
+                on_downloaded=on_downloaded,
+                container_client=container_client
+            )
+            updated = []
+            boxes_processed, zones_processed, failed = self.transform(
+                boxes_processed, zones_processed, futures, updated
+            )
+        # Files that could not be parsed are retried at the next run
+        fingerprints.update(get_changed_files(
+            [file for file in files if file not in failed], {}
+        ))
+        JsonPreprocessingAnalyticsPipeline.load(boxes_processed,
+                                                zones_processed,
+                                                fingerprints,
+                                                updated)
+        print('Ingest ended\n')
+
+    @staticmethod
+    def transform(boxes_processed: dict,
+                  zones_processed: dict,
+                  futures: list,
+                  updated: list = None) -> tuple:
+        failed = []
+        for future in futures:
+            boxes, zones, failed_files = future.result()
+            boxes_processed.update(boxes)
+            zones_processed.update(zones)
+            failed.extend(failed_files)
+            if updated is not None:
+                updated.extend(zones)
+
+        return boxes_processed, zones_processed, set(failed)
+
+
+if __name__ == '__main__':
+    IngestPipeline().launch()
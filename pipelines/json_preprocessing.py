@@ -2,110 +2,192 @@ import glob
 import json
 import os
 import pickle
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Tuple
+
+from stores import BoxesStore
+from utils import (get_changed_files, load_fingerprints, save_fingerprints,
+                   split_in_chunks)
 
 
 class JsonPreprocessingPipeline:
-    
+    # Artifacts read and written, see project.Project
+    inputs = [
+        'Detection_*/*/*.json',
+        'intermediate_process/boxes_processed.pickle',
+        'intermediate_process/zones_processed.pickle',
+        'intermediate_process/json_fingerprints.pickle',
+    ]
+    outputs = [
+        'intermediate_process/boxes_processed.pickle',
+        'intermediate_process/zones_processed.pickle',
+        'intermediate_process/json_fingerprints.pickle',
+        'intermediate_process/boxes_store',
+    ]
+
     def launch(self,
-               path_jsons: str = 'Detection_*/*/*.json'
+               path_jsons: str = 'Detection_*/*/*.json',
+               n_jobs: int = 1,
+               incremental: bool = True
                ) -> None:
         print('JsonPreprocessing launched')
-        boxes_processed, zones_processed, data_jsons = self.extract(path_jsons)
-        boxes_processed, zones_processed = self.transform(
+        fingerprints = self.extract_fingerprints()
+        files = glob.glob(path_jsons)
+        changed = get_changed_files(files,
+                                    fingerprints if incremental else {})
+        print(f'{len(changed)} new or modified files out of {len(files)}')
+        if n_jobs > 1:
+            boxes_processed, zones_processed = self.transform_parallel(
+                *self.extract_processed(), list(changed), n_jobs
+            )
+        else:
+            boxes_processed, zones_processed, data_jsons = self.extract(
+                list(changed)
+            )
+            boxes_processed, zones_processed = self.transform(
+                boxes_processed, zones_processed, data_jsons
+            )
+        fingerprints.update(changed)
+        self.load(boxes_processed, zones_processed, fingerprints)
+        print('JsonPreprocessing ended\n')
+
+    @classmethod
+    def extract(cls, jsons: List[str]) -> Tuple:
+        boxes_processed, zones_processed = cls.extract_processed()
+        data_jsons = cls._read_jsons(jsons)
+
+        return (
             boxes_processed, zones_processed, data_jsons
         )
-        self.load(boxes_processed, zones_processed)
-        print('JsonPreprocessing ended\n')
 
     @staticmethod
-    def extract(path_jsons: str) -> Tuple[dict]:
+    def extract_fingerprints() -> dict:
+        return load_fingerprints(
+            'intermediate_process/json_fingerprints.pickle',
+            ['intermediate_process/boxes_processed.pickle',
+             'intermediate_process/zones_processed.pickle']
+        )
+
+    @staticmethod
+    def extract_processed() -> Tuple[dict]:
         boxes_processed_file = 'intermediate_process/boxes_processed.pickle'
         if not os.path.isfile(boxes_processed_file):
             boxes_processed = {}
         else:
             with open(boxes_processed_file, 'rb') as file:
                 boxes_processed = pickle.load(file)
-        
+
         zones_processed_file = 'intermediate_process/zones_processed.pickle'
         if not os.path.isfile(zones_processed_file):
             zones_processed = {}
         else:
             with open(zones_processed_file, 'rb') as file:
                 zones_processed = pickle.load(file)
-        
-        data_jsons = {
-            str(json_): json.load(open(json_))
-            for json_ in glob.glob(path_jsons)
-        }
-        
-        return (
-            boxes_processed, zones_processed, data_jsons
-        )
+
+        return boxes_processed, zones_processed
 
     @classmethod
     def transform(cls,
                   boxes_processed: dict,
                   zones_processed: dict,
-                  data_jsons: dict) -> Tuple[dict]:
-        return (
-            cls.transform_boxes(boxes_processed, data_jsons),
-            cls.transform_zones(zones_processed, data_jsons)
-        )
+                  data_jsons: Iterable[Tuple[str, dict]]) -> Tuple[dict]:
+        for picture, data in data_jsons:
+            boxes_processed[picture], zones_processed[picture] = (
+                cls._get_boxes_and_zones(data)
+            )
+
+        return boxes_processed, zones_processed
+
+    @classmethod
+    def transform_parallel(cls,
+                           boxes_processed: dict,
+                           zones_processed: dict,
+                           jsons: List[str],
+                           n_jobs: int) -> Tuple[dict]:
+        """
+        Parses and transforms the JSON files with a pool of n_jobs
+        processes. Each process handles a shard of the files and only
+        sends back the reduced boxes and zones, not the raw JSONs.
+        """
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(cls.process_jsons, shard)
+                for shard in split_in_chunks(jsons, n_jobs)
+            ]
+            for future in futures:
+                boxes, zones = future.result()
+                boxes_processed.update(boxes)
+                zones_processed.update(zones)
+
+        return boxes_processed, zones_processed
 
     @staticmethod
-    def load(boxes_processed: dict, zones_processed: dict) -> None:
+    def load(boxes_processed: dict,
+             zones_processed: dict,
+             fingerprints: dict = None) -> None:
         os.makedirs('intermediate_process', exist_ok=True)
         with open('intermediate_process/boxes_processed.pickle', 'wb') as f:
             pickle.dump(boxes_processed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        BoxesStore.save(boxes_processed)
         with open('intermediate_process/zones_processed.pickle', 'wb') as f:
             pickle.dump(zones_processed, f, protocol=pickle.HIGHEST_PROTOCOL)
-            
+        if fingerprints is not None:
+            save_fingerprints(
+                fingerprints,
+                'intermediate_process/json_fingerprints.pickle',
+                ['intermediate_process/boxes_processed.pickle',
+                 'intermediate_process/zones_processed.pickle']
+            )
+
     ##################
     # Helper methods #
     ##################
-    
+
+    @classmethod
+    def process_jsons(cls, jsons: List[str]) -> Tuple[dict]:
+        """
+        Reads and transforms a list of JSON files, so that files can be
+        processed independently, e.g. by a pool of workers.
+
+        Returns
+        -------
+        boxes, zones: dict
+            boxes_processed and zones_processed entries of the files
+        """
+        return cls.transform({}, {}, cls._read_jsons(jsons))
+
     @staticmethod
-    def transform_boxes(boxes_processed:dict, data_jsons: dict) -> dict:
-        for picture in data_jsons.keys():
-            data = data_jsons[picture]
-            mixer_truck_boxes = []
-            people_boxes = []
-            for obj in data['objects']:
-                points = obj['points']['exterior']
-                x_min, y_min = points[0]
-                x_max, y_max = points[1]
-                coords = [x_min, y_min, x_max, y_max]
-                if obj['classTitle'] == 'Mixer_truck':
-                    mixer_truck_boxes.append(coords)
-                if obj['classTitle'] == 'People':
-                    people_boxes.append(coords)
-            img_height = data['size']['height']
-            img_width = data['size']['width']
-            objs = {'Mixer_truck': mixer_truck_boxes, 'People': people_boxes}
-            boxes_processed[picture] = (objs, img_height, img_width)
-        
-        return boxes_processed
-    
+    def _read_jsons(jsons: List[str]) -> Iterator[Tuple[str, dict]]:
+        for json_ in jsons:
+            with open(json_) as file:
+                yield str(json_), json.load(file)
+
     @staticmethod
-    def transform_zones(zones_processed: dict, data_jsons: List[str]) -> List[tuple]:
-        for picture in data_jsons:
-            data = data_jsons[picture]
-            concrete_pumps_zones = []
-            formworks_zones = []
-            for obj in data['objects']:
-                points = obj['points']['exterior']
-                if obj['classTitle'] == 'Concrete_pump_hose':
-                    concrete_pumps_zones.append(points)
-                if obj['classTitle'] == 'Vertical_formwork':
-                    formworks_zones.append(points)
-            img_height = data['size']['height']
-            img_width = data['size']['width']
-            objs = {'Concrete_pump_hose': concrete_pumps_zones,
-                    'Vertical_formwork': formworks_zones}
-            zones_processed[picture] = (objs, img_height, img_width)
-        
-        return zones_processed
+    def _get_boxes_and_zones(data: dict) -> Tuple[tuple]:
+        mixer_truck_boxes = []
+        people_boxes = []
+        concrete_pumps_zones = []
+        formworks_zones = []
+        for obj in data['objects']:
+            points = obj['points']['exterior']
+            if obj['classTitle'] == 'Mixer_truck':
+                mixer_truck_boxes.append([*points[0], *points[1]])
+            elif obj['classTitle'] == 'People':
+                people_boxes.append([*points[0], *points[1]])
+            elif obj['classTitle'] == 'Concrete_pump_hose':
+                concrete_pumps_zones.append(points)
+            elif obj['classTitle'] == 'Vertical_formwork':
+                formworks_zones.append(points)
+        img_height = data['size']['height']
+        img_width = data['size']['width']
+        boxes = {'Mixer_truck': mixer_truck_boxes, 'People': people_boxes}
+        zones = {'Concrete_pump_hose': concrete_pumps_zones,
+                 'Vertical_formwork': formworks_zones}
+
+        return (
+            (boxes, img_height, img_width),
+            (zones, img_height, img_width)
+        )
 
 
 if __name__ == '__main__':
@@ -2,24 +2,107 @@ import glob
 import json
 import os
 import pickle
-from typing import List, Tuple
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from stores import BoxesStore, MaskStore, PictureIndex
+from utils import (bitmap_2_compressed_mask, compress_mask,
+                   draw_cropped_mask, get_changed_files,
+                   get_dates_from_picture_names, load_fingerprints,
+                   save_fingerprints, split_in_chunks)
 
 
 class JsonPreprocessingAnalyticsPipeline:
-    
+    # Artifacts read and written, see project.Project
+    inputs = [
+        'Analytics_*/*/*/*.json',
+        'poly.tar',
+        'intermediate_process/boxes_processed.pickle',
+        'intermediate_process/zones_processed.pickle',
+        'intermediate_process/json_fingerprints.pickle',
+    ]
+    outputs = [
+        'intermediate_process/boxes_processed.pickle',
+        'intermediate_process/zones_processed.pickle',
+        'intermediate_process/json_fingerprints.pickle',
+        'intermediate_process/boxes_store',
+        'intermediate_process/picture_index',
+        'intermediate_process/zones_store',
+    ]
+
     def launch(self,
-               path_jsons: str = 'Analytics_*/*/*/*.json'
+               path_jsons: str = 'Analytics_*/*/*/*.json',
+               path_archive: str = 'poly.tar',
+               n_jobs: int = 1,
+               incremental: bool = True
                ) -> None:
         print('JsonPreprocessingAnalytics launched')
-        boxes_processed, zones_processed, data_jsons = self.extract(path_jsons)
-        boxes_processed, zones_processed = self.transform(
+        fingerprints = self.extract_fingerprints()
+        files = glob.glob(path_jsons)
+        if os.path.isfile(path_archive):
+            files.append(path_archive)
+        changed = get_changed_files(files,
+                                    fingerprints if incremental else {})
+        print(f'{len(changed)} new or modified files out of {len(files)}')
+        jsons = [json_ for json_ in changed if json_ != path_archive]
+        path_archive = path_archive if path_archive in changed else None
+        updated = []
+        if n_jobs > 1:
+            boxes_processed, zones_processed, failed = self.transform_parallel(
+                *self.extract_processed(), jsons, path_archive, n_jobs,
+                updated
+            )
+        else:
+            failed = []
+            boxes_processed, zones_processed, data_jsons = self.extract(
+                jsons, path_archive, failed
+            )
+            boxes_processed, zones_processed = self.transform(
+                boxes_processed, zones_processed, data_jsons, updated
+            )
+        # Files that could not be parsed are retried at the next run
+        fingerprints.update({
+            file: fingerprint for file, fingerprint in changed.items()
+            if file not in failed
+        })
+        self.load(boxes_processed, zones_processed, fingerprints, updated)
+        print('JsonPreprocessingAnalytics ended\n')
+
+    @classmethod
+    def extract(cls,
+                jsons: List[str],
+                path_archive: str = None,
+                failed: List[str] = None) -> Tuple:
+        """
+        data_jsons is a generator of (picture, data) pairs: the JSON files
+        are read one at a time while they are transformed, so that memory
+        usage does not grow with the number of files. The files that cannot
+        be parsed are added to failed while data_jsons is consumed.
+        """
+        boxes_processed, zones_processed = cls.extract_processed()
+        data_jsons = cls._read_jsons(jsons, failed)
+        if path_archive is not None and os.path.isfile(path_archive):
+            data_jsons = chain(data_jsons,
+                               cls._read_archive(path_archive, failed=failed))
+
+        return (
             boxes_processed, zones_processed, data_jsons
         )
-        self.load(boxes_processed, zones_processed)
-        print('JsonPreprocessingAnalytics ended\n')
 
     @staticmethod
-    def extract(path_jsons: str) -> Tuple[dict]:
+    def extract_fingerprints() -> dict:
+        return load_fingerprints(
+            'intermediate_process/json_fingerprints.pickle',
+            ['intermediate_process/boxes_processed.pickle',
+             'intermediate_process/zones_processed.pickle']
+        )
+
+    @staticmethod
+    def extract_processed() -> Tuple[dict]:
         boxes_processed_file = 'intermediate_process/boxes_processed.pickle'
         if not os.path.isfile(boxes_processed_file):
             boxes_processed = {}
@@ -33,101 +116,260 @@ class JsonPreprocessingAnalyticsPipeline:
         else:
             with open(zones_processed_file, 'rb') as file:
                 zones_processed = pickle.load(file)
-        
-        data_jsons = {}
-        for json_ in glob.glob(path_jsons):
-            try:
-                data_jsons[str(json_)] = json.load(open(json_, 'rb'))
-            except:
-                print(json_)
 
-        return (
-            boxes_processed, zones_processed, data_jsons
-        )
+        return boxes_processed, zones_processed
 
     @classmethod
     def transform(cls,
                   boxes_processed: dict,
                   zones_processed: dict,
-                  data_jsons: dict) -> Tuple[dict]:
-        return (
-            cls.transform_boxes(boxes_processed, data_jsons),
-            cls.transform_zones(zones_processed, data_jsons)
-        )
+                  data_jsons: Iterable[Tuple[str, dict]],
+                  updated: List[str] = None) -> Tuple[dict]:
+        """
+        The pictures whose zones are transformed are added to updated.
+        """
+        for picture, data in data_jsons:
+            if 'people' in picture:
+                boxes_processed[cls._change_name(picture)] = (
+                    cls._get_boxes(data)
+                )
+            if 'poly' in picture:
+                zones_processed[cls._change_name(picture)] = (
+                    cls._get_zones(data)
+                )
+                if updated is not None:
+                    updated.append(cls._change_name(picture))
 
-    @staticmethod
-    def load(boxes_processed: dict, zones_processed: dict) -> None:
+        return boxes_processed, zones_processed
+
+    @classmethod
+    def transform_parallel(cls,
+                           boxes_processed: dict,
+                           zones_processed: dict,
+                           jsons: List[str],
+                           path_archive: str,
+                           n_jobs: int,
+                           updated: List[str] = None) -> Tuple[dict]:
+        """
+        Parses and transforms the JSON files with a pool of n_jobs
+        processes. Each process handles a shard of the files and only
+        sends back the reduced boxes and zones, not the raw JSONs. The
+        pictures whose zones are transformed are added to updated.
+
+        Returns
+        -------
+        boxes_processed, zones_processed: dict
+        failed: list
+            files that could not be parsed
+        """
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(cls.process_jsons, shard)
+                for shard in split_in_chunks(jsons, n_jobs)
+            ]
+            if path_archive is not None and os.path.isfile(path_archive):
+                futures.append(
+                    executor.submit(cls.process_archive, path_archive)
+                )
+            failed = []
+            for future in futures:
+                boxes, zones, failed_files = future.result()
+                boxes_processed.update(boxes)
+                zones_processed.update(zones)
+                failed.extend(failed_files)
+                if updated is not None:
+                    updated.extend(zones)
+
+        return boxes_processed, zones_processed, failed
+
+    @classmethod
+    def load(cls,
+             boxes_processed: dict,
+             zones_processed: dict,
+             fingerprints: dict = None,
+             updated: List[str] = None) -> None:
+        """
+        Only the zones of the updated pictures are added to zones_store,
+        all the zones being saved again if updated is None.
+        """
         os.makedirs('intermediate_process', exist_ok=True)
         with open('intermediate_process/boxes_processed.pickle', 'wb') as f:
             pickle.dump(boxes_processed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        BoxesStore.save(boxes_processed)
         with open('intermediate_process/zones_processed.pickle', 'wb') as f:
             pickle.dump(zones_processed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        PictureIndex.save([*boxes_processed, *zones_processed])
+        zones_store = 'intermediate_process/zones_store'
+        if updated is None or not os.path.isdir(zones_store):
+            MaskStore.save(cls._get_dated_zones(zones_processed),
+                           folder=zones_store)
+        else:
+            MaskStore.merge(cls._get_dated_zones({
+                picture: zones_processed[picture] for picture in updated
+            }), folder=zones_store)
+        if fingerprints is not None:
+            save_fingerprints(
+                fingerprints,
+                'intermediate_process/json_fingerprints.pickle',
+                ['intermediate_process/boxes_processed.pickle',
+                 'intermediate_process/zones_processed.pickle']
+            )
             
     ##################
     # Helper methods #
     ##################
     
     @classmethod
-    def transform_boxes(cls, boxes_processed: dict, data_jsons: dict) -> dict:
-        for picture in data_jsons.keys():
-            data = data_jsons[picture]
-            if 'people' not in picture:
-                continue
-            picture = cls._change_name(picture)
-            people_boxes = []
-            for obj in data['objects']:
-                points = obj['points']['exterior']
-                x_min, y_min = points[0]
-                x_max, y_max = points[1]
-                coords = [x_min, y_min, x_max, y_max]
-                if obj['classTitle'] == 'People_model':
-                    people_boxes.append(coords)
-            img_height = data['size']['height']
-            img_width = data['size']['width']
-            objs = {'People': people_boxes}
-            boxes_processed[picture] = (objs, img_height, img_width)
-        
-        return boxes_processed
-    
+    def process_json(cls, json_: str) -> Tuple[dict]:
+        """
+        Reads and transforms a single JSON file, so that files can be
+        processed independently, e.g. by a pool of workers.
+
+        Returns
+        -------
+        boxes, zones: dict
+            boxes_processed and zones_processed entries of the file
+        failed: list
+            the file if it could not be parsed
+        """
+        return cls.process_jsons([json_])
+
     @classmethod
-    def transform_zones(cls,
-                        zones_processed: dict,
-                        data_jsons: List[str]) -> List[tuple]:
-        for picture in data_jsons:
-            data = data_jsons[picture]
-            if 'poly' not in picture:
+    def process_jsons(cls, jsons: List[str]) -> Tuple[dict]:
+        """
+        Same as process_json for a list of JSON files.
+        """
+        failed = []
+
+        return (*cls.transform({}, {}, cls._read_jsons(jsons, failed)), failed)
+
+    @classmethod
+    def process_archive(cls, path_archive: str) -> Tuple[dict]:
+        """
+        Same as process_json for a tar archive of JSON files, the archive
+        being failed if any of its files could not be parsed.
+        """
+        failed = []
+        boxes, zones = cls.transform(
+            {}, {}, cls._read_archive(path_archive, failed=failed)
+        )
+
+        return boxes, zones, failed
+
+    @staticmethod
+    def _read_jsons(jsons: List[str],
+                    failed: List[str] = None) -> Iterator[Tuple[str, dict]]:
+        for json_ in jsons:
+            try:
+                with open(json_, 'rb') as file:
+                    data = json.load(file)
+            except:
+                print(json_)
+                if failed is not None:
+                    failed.append(json_)
                 continue
-            picture = cls._change_name(picture)
-            horizontal_zones = []
-            vertical_zones = []
-            rebars_zones = []
-            concrete_pumps = []
-            for obj in data['objects']:
-                encoded_mask = obj['bitmap']
-                if obj['classTitle'] in ['Vertical formwork_model',
-                                         'Vertical_formwork']:
-                    vertical_zones.append(encoded_mask)
-                elif obj['classTitle'] in ['Rebars_model',
-                                           'Rebars']:
-                    rebars_zones.append(encoded_mask)
-                elif obj['classTitle'] in ['Horizontal formwork_model',
-                                           'Horizontal_formwork']:
-                    horizontal_zones.append(encoded_mask)
-                elif obj['classTitle'] in ['Concrete pump hose',
-                                           'Concrete_pump_hose']:
-                    concrete_pumps.append(encoded_mask)
-                else:
-                    print(obj['classTitle'])
-            img_height = data['size']['height']
-            img_width = data['size']['width']
-            objs = {'Vertical_formwork': vertical_zones,
-                    'Horizontal_formwork': horizontal_zones,
-                    'Concrete_pump_hose': concrete_pumps,
-                    'Rebars': rebars_zones}
-            zones_processed[picture] = (objs, img_height, img_width)
-        
-        return zones_processed
+            yield str(json_), data
+
+    @staticmethod
+    def _read_archive(
+        path_archive: str,
+        folder: str = 'Analytics_Train_Set/Analytics_Train_Set_Json/poly/',
+        strip_components: int = 1,
+        failed: List[str] = None
+    ) -> Iterator[Tuple[str, dict]]:
+        """
+        Parses the JSON files of a tar archive in a single sequential
+        read, without extracting them to disk. Members are named as if
+        the archive had been extracted in folder with
+        `tar --strip-components`. If a member cannot be parsed, the
+        archive is added to failed.
+        """
+        with tarfile.open(path_archive, 'r|*') as archive:
+            for member in archive:
+                if not member.isfile() or not member.name.endswith('.json'):
+                    continue
+                name = '/'.join(member.name.split('/')[strip_components:])
+                try:
+                    data = json.load(archive.extractfile(member))
+                except:
+                    print(member.name)
+                    if failed is not None and path_archive not in failed:
+                        failed.append(path_archive)
+                    continue
+                yield folder + name, data
+
+    @staticmethod
+    def _get_boxes(data: dict) -> tuple:
+        people_boxes = []
+        for obj in data['objects']:
+            points = obj['points']['exterior']
+            x_min, y_min = points[0]
+            x_max, y_max = points[1]
+            coords = [x_min, y_min, x_max, y_max]
+            if obj['classTitle'] == 'People_model':
+                people_boxes.append(coords)
+        img_height = data['size']['height']
+        img_width = data['size']['width']
+        objs = {'People': people_boxes}
+
+        return (objs, img_height, img_width)
+
+    @staticmethod
+    def _get_zones(data: dict) -> tuple:
+        horizontal_zones = []
+        vertical_zones = []
+        rebars_zones = []
+        concrete_pumps = []
+        for obj in data['objects']:
+            encoded_mask = bitmap_2_compressed_mask(obj['bitmap'])
+            if obj['classTitle'] in ['Vertical formwork_model',
+                                     'Vertical_formwork']:
+                vertical_zones.append(encoded_mask)
+            elif obj['classTitle'] in ['Rebars_model',
+                                       'Rebars']:
+                rebars_zones.append(encoded_mask)
+            elif obj['classTitle'] in ['Horizontal formwork_model',
+                                       'Horizontal_formwork']:
+                horizontal_zones.append(encoded_mask)
+            elif obj['classTitle'] in ['Concrete pump hose',
+                                       'Concrete_pump_hose']:
+                concrete_pumps.append(encoded_mask)
+            else:
+                print(obj['classTitle'])
+        img_height = data['size']['height']
+        img_width = data['size']['width']
+        objs = {'Vertical_formwork': vertical_zones,
+                'Horizontal_formwork': horizontal_zones,
+                'Concrete_pump_hose': concrete_pumps,
+                'Rebars': rebars_zones}
+
+        return (objs, img_height, img_width)
     
+    @staticmethod
+    def _get_dated_zones(zones_processed: dict) -> dict:
+        """
+        Zones of the pictures of stores.PictureIndex, i.e. with a date in
+        their name, as compressed masks to be saved in a stores.MaskStore:
+        the polygons of the Detection set are rasterized.
+        """
+        pictures = list(zones_processed)
+        dates = get_dates_from_picture_names(pictures)
+        dated_zones = {}
+        for picture, date in zip(pictures, dates):
+            if np.isnat(date):
+                continue
+            zones_by_type, height, width = zones_processed[picture]
+            dated_zones[picture] = ({
+                zone_type: [
+                    zone if type(zone) is dict and 'bits' in zone
+                    else compress_mask(*draw_cropped_mask(zone, height, width))
+                    for zone in zones
+                ]
+                for zone_type, zones in zones_by_type.items()
+            }, height, width)
+
+        return dated_zones
+
     @staticmethod
     def _change_name(picture: str) -> str:
         return (
@@ -0,0 +1,173 @@
+import os
+import pickle
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from stores import BoxesStore
+from utils import get_date_from_picture_name
+
+from .plot_worker import PlotWorkerPipeline
+
+
+class ParameterSweepPipeline:
+    """
+    Computes the number of active workers for a grid of ranges of action
+    (see constants.WORKERS_RANGE_OF_ACTION) and smoothing windows (see
+    PlotWorkerPipeline.smooth_df), computing the distances of each picture
+    only once.
+    """
+
+    def launch(self,
+               ranges_of_action: List[float] = (1., 1.5, 2., 2.5, 3., 3.5, 4.),
+               half_windows: List[str] = ('0min', '5min', '10min', '30min')
+               ) -> None:
+        print('ParameterSweep launched')
+        boxes, pump = self.extract()
+        sweep_df = self.transform(boxes, pump, ranges_of_action, half_windows)
+        self.load(sweep_df)
+        print('ParameterSweep ended\n')
+
+    @staticmethod
+    def extract() -> Tuple:
+        boxes_processed = BoxesStore()
+        with open('intermediate_process/pump_key_points.pickle', 'rb') as file:
+            pump_key_points = pickle.load(file)
+
+        return boxes_processed, pump_key_points
+
+    @classmethod
+    def transform(cls,
+                  boxes: BoxesStore,
+                  pump: dict,
+                  ranges_of_action: List[float],
+                  half_windows: List[str]) -> pd.DataFrame:
+        """
+        Returns
+        -------
+        sweep_df: pd.DataFrame
+            one row per range of action, half range and date, with the
+            smoothed numbers of active workers and of workers
+        """
+        ranges_of_action = np.asarray(ranges_of_action, dtype=float)
+        pump_workers_by_date = {}
+        for picture in pump.keys():
+            if not picture.startswith('Analytics'):
+                continue
+            try:
+                workers = boxes.get_boxes(picture, 'People')
+            except KeyError:
+                workers = np.zeros((0, 4))
+            pump_workers_by_date[get_date_from_picture_name(picture)] = (
+                cls._count_pump_workers(workers, pump[picture]['extremity'],
+                                        ranges_of_action)
+            )
+        dates = sorted(pump_workers_by_date)
+        pump_workers = np.array(
+            [pump_workers_by_date[date] for date in dates]
+        ).reshape(len(dates), len(ranges_of_action))
+        workers_series = PlotWorkerPipeline.create_workers_df(boxes)
+
+        sweep = []
+        for half_window in half_windows:
+            workers_smoothed = PlotWorkerPipeline.smooth_df(workers_series,
+                                                            half_window)
+            for k, range_of_action in enumerate(ranges_of_action):
+                pump_workers_smoothed = PlotWorkerPipeline.smooth_df(
+                    pd.Series(pump_workers[:, k], index=pd.to_datetime(dates)),
+                    half_window
+                )
+                sweep.append(pd.DataFrame({
+                    'range_of_action': range_of_action,
+                    'half_window': half_window,
+                    'date': pump_workers_smoothed.index,
+                    'pump_workers': pump_workers_smoothed.values,
+                    'workers': workers_smoothed.reindex(
+                        pump_workers_smoothed.index
+                    ).values,
+                }))
+
+        return pd.concat(sweep, ignore_index=True)
+
+    @staticmethod
+    def load(sweep_df: pd.DataFrame) -> None:
+        output_folder = 'output_csv/'
+        os.makedirs(output_folder, exist_ok=True)
+        sweep_df.to_csv(f'{output_folder}parameter_sweep.csv', index=False)
+
+    ##################
+    # Helper methods #
+    ##################
+
+    @classmethod
+    def _count_pump_workers(cls,
+                            workers: np.array,
+                            pump_centers: List[Tuple[int]],
+                            ranges_of_action: np.array) -> np.array:
+        """
+        Number of workers associated to the pumps of a picture for each
+        range of action, as in WorkingWorkersPipeline.
+
+        A worker is associated to a pump for a range of action if the
+        longest step of the best path from the pump to the worker is within
+        range, so that computing this longest step once per worker gives
+        the result for every range of action.
+        """
+        workers = np.asarray(workers).reshape(-1, 4)
+        centers = np.stack([(workers[:, 0]+workers[:, 2])//2,
+                            (workers[:, 1]+workers[:, 3])//2], axis=1)
+        typical_size = np.max(np.maximum(
+            np.abs(workers[:, 2]-workers[:, 0]),
+            np.abs(workers[:, 3]-workers[:, 1])
+        ), initial=0)
+        distances = np.sqrt(
+            ((centers[:, None, :] - centers[None, :, :])**2).sum(axis=2)
+        )
+        valid = np.all(centers != 0, axis=1)
+
+        counts = np.zeros(len(ranges_of_action), dtype=int)
+        # WorkingWorkersPipeline keys the workers by pump center, so that
+        # pumps with the same extremity are counted once
+        for pump_center in dict.fromkeys(map(tuple, pump_centers)):
+            if not (pump_center[0] and pump_center[1]):
+                continue
+            longest_steps = cls._get_longest_steps(
+                np.sqrt(((centers - pump_center)**2).sum(axis=1)),
+                distances, valid
+            )
+            counts += (
+                longest_steps[None, :]
+                <= typical_size * ranges_of_action[:, None]
+            ).sum(axis=1)
+
+        return counts
+
+    @staticmethod
+    def _get_longest_steps(pump_distances: np.array,
+                           distances: np.array,
+                           valid: np.array) -> np.array:
+        """
+        Minimax path distances from the pump to each worker (Prim's
+        algorithm): the smallest possible longest step of a path from the
+        pump to the worker. Invalid workers end paths but do not relay them.
+        """
+        longest_steps = pump_distances.astype(float)
+        done = np.zeros(len(longest_steps), dtype=bool)
+        for _ in range(len(longest_steps)):
+            i = np.argmin(np.where(done, np.inf, longest_steps))
+            if done[i] or np.isinf(longest_steps[i]):
+                break
+            done[i] = True
+            if valid[i]:
+                longest_steps = np.where(
+                    done, longest_steps,
+                    np.minimum(longest_steps,
+                               np.maximum(longest_steps[i], distances[i]))
+                )
+
+        return longest_steps
+
+
+if __name__ == '__main__':
+    ParameterSweepPipeline().launch()
@@ -1,48 +1,70 @@
 import os
 import pickle
-from typing import List, Tuple
+from typing import Tuple
 
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
+from utils import Heatmap
 
 
 class PlotHeatmapPipeline:
+    # Artifacts read and written, see project.Project
+    inputs = [
+        'intermediate_process/pump_key_points.pickle',
+        'intermediate_process/zones_processed.pickle',
+    ]
+    outputs = [
+        'output_csv/extremity_heatmap.npy',
+        'output_csv/extremity_heatmap.png',
+    ]
 
-    def launch(self) -> None:
+    def launch(self, bins: Tuple[int] = (128, 160)) -> None:
         print('PlotHeatmap launched')
-        pump_key_points = self.extract()
-        xs, ys = self.transform(pump_key_points)
-        self.load(xs, ys)
+        pump_key_points, zones_processed = self.extract()
+        heatmap = self.transform(pump_key_points, zones_processed, bins)
+        self.load(heatmap)
         print('PlotHeatmap ended\n')
-    
+
     @staticmethod
-    def extract() -> dict:
+    def extract() -> Tuple[dict]:
         with open('intermediate_process/pump_key_points.pickle', 'rb') as file:
             pump_key_points = pickle.load(file)
-        
-        return pump_key_points
-    
+        with open('intermediate_process/zones_processed.pickle', 'rb') as file:
+            zones_processed = pickle.load(file)
+
+        return pump_key_points, zones_processed
+
     @staticmethod
-    def transform(pump_key_points: dict) -> Tuple[List[int]]:
-        xs, ys = [], []
-        for figure in pump_key_points.keys():
-            for coord in pump_key_points[figure]['extremity']:
-                xs.append(coord[0])
-                ys.append(1024 - coord[1] if coord[1] is not None else None)
-        
-        return xs, ys
+    def transform(pump_key_points: dict,
+                  zones_processed: dict,
+                  bins: Tuple[int] = (128, 160)) -> Heatmap:
+        """
+        Bins the pump extremities of each picture relative to its own size,
+        given by zones_processed from which they were computed (see
+        utils.Heatmap).
+        """
+        heatmap = Heatmap(bins)
+        for picture, key_points in pump_key_points.items():
+            _, height, width = zones_processed[picture]
+            heatmap.add(key_points['extremity'], height, width)
+
+        return heatmap
 
     @staticmethod
-    def load(xs: List[int], ys: List[int]) -> None:
+    def load(heatmap: Heatmap) -> None:
+        # Imported when rendering only, as it is long to import
+        import matplotlib.pyplot as plt
+
         output_folder = 'output_csv/'
         os.makedirs(output_folder, exist_ok=True)
+        heatmap.save(f'{output_folder}extremity_heatmap.npy')
         fig, ax = plt.subplots(1)
-        plt.scatter(xs, ys, c=range(len(xs)))
-        ax.add_patch(Rectangle((0, 0), 1280, 1024, fill=False))
-        plt.colorbar()
-        plt.axis('equal')
-        plt.savefig(f'{output_folder}extremity_heatmap.png')
+        n_rows, n_cols = heatmap.counts.shape
+        image = ax.imshow(heatmap.counts, cmap='hot', interpolation='nearest',
+                          extent=(0, 1, 1, 0), aspect=n_rows / n_cols)
+        ax.set_xlabel('x / width')
+        ax.set_ylabel('y / height')
+        fig.colorbar(image)
+        fig.savefig(f'{output_folder}extremity_heatmap.png')
+        plt.close(fig)
 
 if __name__=='__main__':
     PlotHeatmapPipeline().launch()
-
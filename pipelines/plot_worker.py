@@ -1,44 +1,99 @@
-import os
 import pickle
 from datetime import datetime
 from typing import Tuple
 
 import pandas as pd
 
-from utils import get_date_from_picture_name
+from constants import SMOOTHING_HALF_WINDOW
+from stores import BoxesStore, PartitionedTimeSeries, TimeSeriesStore
+from utils import get_date_from_picture_name, rolling_time_window
 
 
 class PlotWorkerPipeline:
+    # Artifacts read and written, see project.Project
+    inputs = [
+        'intermediate_process/pump_and_workers.pickle',
+        'intermediate_process/boxes_store',
+    ]
+    outputs = [
+        'output_csv/pump_workers_by_date.csv',
+        'output_csv/workers_by_date.csv',
+        'output_series',
+    ]
 
-    def launch(self) -> None:
+    def launch(self,
+               incremental: bool = True,
+               partitioned: bool = True) -> None:
         print('PlotWorker launched')
-        workers_by_pump_by_picture, boxes_processed = self.extract()
-        pump_workers_series, workers_series = self.transform(workers_by_pump_by_picture, boxes_processed)
-        self.load(pump_workers_series, workers_series)
+        (workers_by_pump_by_picture, boxes_processed,
+         pump_workers_stores, workers_stores) = self.extract(incremental,
+                                                            partitioned)
+        pump_workers, workers = self.transform(workers_by_pump_by_picture,
+                                               boxes_processed)
+        self.load(pump_workers_stores, pump_workers, workers_stores, workers)
         print('PlotWorker ended\n')
     
     @staticmethod
-    def extract() -> Tuple[dict]:
+    def extract(incremental: bool = True, partitioned: bool = True) -> Tuple:
+        """
+        Returns the stores of each series: the CSV file, and the partitions
+        by site and day if partitioned (see stores.PartitionedTimeSeries)
+        """
         with open('intermediate_process/pump_and_workers.pickle', 'rb') as file:
             workers_by_pump_by_picture = pickle.load(file)
-        with open('intermediate_process/boxes_processed.pickle', 'rb') as file:
-            boxes_processed = pickle.load(file)
+        boxes_processed = BoxesStore()
+        pump_workers_stores, workers_stores = [], []
+        for series, stores in [('pump_workers', pump_workers_stores),
+                               ('workers', workers_stores)]:
+            stores.append(TimeSeriesStore(
+                f'intermediate_process/{series}_series',
+                f'output_csv/{series}_by_date.csv',
+                incremental=incremental
+            ))
+            if partitioned:
+                stores.append(PartitionedTimeSeries(
+                    f'output_series/{series}',
+                    f'intermediate_process/{series}_series_by_site',
+                    incremental=incremental
+                ))
         
-        return workers_by_pump_by_picture, boxes_processed
+        return (workers_by_pump_by_picture, boxes_processed,
+                pump_workers_stores, workers_stores)
     
-    @classmethod
-    def transform(cls, workers_by_pump_by_picture: dict, boxes_processed: dict) -> Tuple[pd.Series]:
-        return (
-            cls.smooth_df(cls.create_pump_workers_df(workers_by_pump_by_picture)),
-            cls.smooth_df(cls.create_workers_df(boxes_processed))
-        )
+    @staticmethod
+    def transform(workers_by_pump_by_picture: dict,
+                  boxes_processed: BoxesStore) -> Tuple[dict]:
+        """
+        Returns
+        -------
+        pump_workers, workers: dict
+            number of active workers and of workers of each picture, the
+            stores only rewriting the rows of new or changed pictures
+        """
+        pump_workers = {
+            picture: sum(len(workers) for workers in workers_by_pump.values())
+            for picture, workers_by_pump in workers_by_pump_by_picture.items()
+            if picture.startswith('Analytics')
+        }
+        workers = {
+            picture: int(count)
+            for picture, count in zip(map(str, boxes_processed.pictures),
+                                      boxes_processed.count_boxes('People'))
+            if picture.startswith('Analytics')
+        }
+
+        return pump_workers, workers
     
     @staticmethod
-    def load(pump_workers_series: pd.Series, workers_series: pd.Series) -> None:
-        output_folder = 'output_csv/'
-        os.makedirs(output_folder, exist_ok=True)
-        pump_workers_series.to_csv(f'{output_folder}pump_workers_by_date.csv')
-        workers_series.to_csv(f'{output_folder}workers_by_date.csv')
+    def load(pump_workers_stores: list,
+             pump_workers: dict,
+             workers_stores: list,
+             workers: dict) -> None:
+        for stores, values in [(pump_workers_stores, pump_workers),
+                               (workers_stores, workers)]:
+            for store in stores:
+                n_updated = store.update(values)
+                print(f'{store.folder}: {n_updated} updated')
 
     
     ##################
@@ -59,21 +114,32 @@ class PlotWorkerPipeline:
         return pd.Series(pump_workers_by_date).sort_index()
     
     @staticmethod
-    def create_workers_df(boxes_processed: dict) -> pd.Series:
+    def create_workers_df(boxes_processed: BoxesStore) -> pd.Series:
         workers_by_date = {}
-        for picture in boxes_processed.keys():
+        workers_counts = boxes_processed.count_boxes('People')
+        for picture, count in zip(boxes_processed.pictures, workers_counts):
             if not picture.startswith('Analytics'):
                 continue
             date = get_date_from_picture_name(picture)
-            workers_by_date[date] = len(boxes_processed[picture][0]['People'])
+            workers_by_date[date] = int(count)
         
         return pd.Series(workers_by_date).sort_index()
     
     @staticmethod
-    def smooth_df(s: pd.Series, half_range: int = 5) -> pd.Series:
-        return pd.DataFrame([
-            s.shift(i) for i in range(-half_range, half_range+1)
-        ]).transpose().max(axis=1)
+    def smooth_df(s: pd.Series,
+                  half_window: str = SMOOTHING_HALF_WINDOW,
+                  statistic: str = 'max',
+                  q: float = 0.5) -> pd.Series:
+        """
+        Rolling max, median or quantile of s over the dates within
+        half_window (e.g. '10min') of each date of its index. A number of
+        frames, as the former half_range, raises a TypeError.
+        """
+        return pd.Series(
+            rolling_time_window(s.values, s.index.values, half_window,
+                                statistic, q),
+            index=s.index
+        )
 
 
 if __name__=='__main__':
@@ -5,10 +5,18 @@ from typing import List, Tuple
 import numpy as np
 
 from constants import WORKERS_RANGE_OF_ACTION
-from utils import get_typical_size
+from stores import BoxesStore
 
 
 class WorkingWorkersPipeline:
+    # Artifacts read and written, see project.Project
+    inputs = [
+        'intermediate_process/boxes_store',
+        'intermediate_process/pump_key_points.pickle',
+    ]
+    outputs = [
+        'intermediate_process/pump_and_workers.pickle',
+    ]
 
     def launch(self) -> None:
         print('WorkingWorkers launched')
@@ -16,47 +24,53 @@ class WorkingWorkersPipeline:
         pump_by_picture = self.transform(boxes, pump)
         self.load(pump_by_picture)
         print('WorkingWorkers ended\n')
-    
+
     @staticmethod
-    def extract() -> Tuple[dict]:
-        with open('intermediate_process/boxes_processed.pickle', 'rb') as file:
-            boxes_processed = pickle.load(file)
+    def extract() -> Tuple:
+        boxes_processed = BoxesStore()
         with open('intermediate_process/pump_key_points.pickle', 'rb') as file:
             pump_centers = pickle.load(file)
-        
+
         return boxes_processed, pump_centers
-    
+
     @classmethod
-    def transform(cls, boxes: dict, pump: dict):
-        pump_by_picture = {}
-        cpt = 0
-        for picture in pump.keys():
-            pump_centers = pump[picture]['extremity']
-            try:
-                workers = boxes[picture][0]['People']
-            except KeyError:
-                cpt+=1
-                print('no workers for', picture, cpt)
-                workers = []
-            workers_centers = cls._get_workers_centers(workers)
-            typical_range_of_action = (
-                get_typical_size(workers)*WORKERS_RANGE_OF_ACTION
-            )
-            workers_by_pump = {}
-            for pump_center in pump_centers:
-                previous_workers_nb = -1
-                current_workers_nb = 0
-                centers = [pump_center]
-                while current_workers_nb > previous_workers_nb:
-                    working_workers = cls._find_workers_from_centers(
-                        centers, workers_centers, typical_range_of_action
-                    )
-                    previous_workers_nb = current_workers_nb
-                    current_workers_nb = len(working_workers)
-                    centers = [pump_center, *working_workers]
-                workers_by_pump[pump_center] = working_workers
-            pump_by_picture[picture] = workers_by_pump
-        
+    def transform(cls, boxes: BoxesStore, pump: dict):
+        """
+        The workers and pump extremities of all the pictures are packed in
+        flat arrays, so that distances are computed for all the pictures at
+        once. The workers transitively within range of each pump are then
+        found by a breadth-first search on the pairs in range.
+        """
+        pictures = list(pump.keys())
+        workers, worker_pictures = cls._pack_workers(boxes, pictures)
+        workers_centers = cls._get_workers_centers(workers)
+        typical_ranges_of_action = (
+            cls._get_typical_sizes(workers, worker_pictures, len(pictures))
+            * WORKERS_RANGE_OF_ACTION
+        )
+        pump_centers, pump_pictures = cls._pack_pump_centers(pump, pictures)
+
+        pump_neighbours = cls._get_neighbours(
+            pump_centers, pump_pictures,
+            workers_centers, worker_pictures, typical_ranges_of_action
+        )
+        workers_neighbours = cls._get_neighbours(
+            workers_centers, worker_pictures,
+            workers_centers, worker_pictures, typical_ranges_of_action
+        )
+
+        pump_by_picture = {picture: {} for picture in pictures}
+        pump_index = 0
+        for picture in pictures:
+            for pump_center in pump[picture]['extremity']:
+                working_workers = cls._find_working_workers(
+                    pump_neighbours[pump_index], workers_neighbours
+                )
+                pump_by_picture[picture][pump_center] = [
+                    workers_centers[i].tolist() for i in working_workers
+                ]
+                pump_index += 1
+
         return pump_by_picture
 
     @staticmethod
@@ -70,43 +84,177 @@ class WorkingWorkersPipeline:
     ##################
 
     @staticmethod
-    def _get_workers_centers(workers: List[List[int]]) -> List[int]:
-        return [
-            [(worker[0]+worker[2])//2, (worker[1]+worker[3])//2]
-            for worker in workers
+    def _pack_workers(boxes: BoxesStore,
+                      pictures: List[str]) -> Tuple[np.array]:
+        """
+        Returns
+        -------
+        workers: np.array
+            boxes of the workers of all the pictures, shape (n, 4)
+        worker_pictures: np.array
+            index in pictures of the picture of each worker
+        """
+        workers, worker_pictures = [np.zeros((0, 4), dtype=np.int64)], []
+        cpt = 0
+        for i, picture in enumerate(pictures):
+            try:
+                picture_workers = boxes.get_boxes(picture, 'People')
+            except KeyError:
+                cpt+=1
+                print('no workers for', picture, cpt)
+                continue
+            workers.append(picture_workers.reshape(-1, 4))
+            worker_pictures.append(np.full(len(picture_workers), i))
+
+        return (
+            np.concatenate(workers),
+            np.concatenate([np.zeros(0, dtype=int), *worker_pictures])
+        )
+
+    @staticmethod
+    def _pack_pump_centers(pump: dict,
+                           pictures: List[str]) -> Tuple[np.array]:
+        """
+        Pump extremities of all the pictures, missing coordinates being NaN
+        """
+        pump_centers = [
+            [np.nan if coord is None else coord for coord in pump_center]
+            for picture in pictures
+            for pump_center in pump[picture]['extremity']
+        ]
+        pump_pictures = [
+            i
+            for i, picture in enumerate(pictures)
+            for _ in pump[picture]['extremity']
         ]
 
-    @classmethod
-    def _find_workers_from_centers(
-        cls,
-        centers: List[List[int]],
-        workers: List[List[int]],
-        typical_range_of_action: int
-    ) -> List[List[int]]:
-
-        working_workers = []
-        for worker in workers:
-            if worker in centers:
-                working_workers.append(worker)
-            elif cls._compute_distance(centers,
-                                       worker) <= typical_range_of_action:
-                working_workers.append(worker)
-        
-        return working_workers
-    
+        return (
+            np.array(pump_centers, dtype=float).reshape(-1, 2),
+            np.array(pump_pictures, dtype=int)
+        )
+
     @staticmethod
-    def _compute_distance(centers: List[List[int]],
-                          object_: List[int]) -> float:
-        distances = []
-        for center in centers:
-            if center[0] and center[1]:
-                distances.append(np.sqrt(
-                    (object_[0]-center[0])**2 + (object_[1]-center[1])**2)
-                )
-            else:
-                distances.append(np.inf)
-        
-        return min(distances)
+    def _get_workers_centers(workers: np.array) -> np.array:
+        return np.stack([(workers[:, 0]+workers[:, 2])//2,
+                         (workers[:, 1]+workers[:, 3])//2], axis=1)
+
+    @staticmethod
+    def _get_typical_sizes(workers: np.array,
+                           worker_pictures: np.array,
+                           n_pictures: int) -> np.array:
+        """
+        Vectorized utils.get_typical_size for the workers of all pictures
+        """
+        sizes = np.zeros(n_pictures)
+        np.maximum.at(sizes, worker_pictures, np.maximum(
+            np.abs(workers[:, 2]-workers[:, 0]),
+            np.abs(workers[:, 3]-workers[:, 1])
+        ))
+
+        return sizes
+
+    @staticmethod
+    def _get_neighbours(centers: np.array,
+                        center_pictures: np.array,
+                        workers: np.array,
+                        worker_pictures: np.array,
+                        ranges: np.array,
+                        block_size: int = 2**20) -> List[np.array]:
+        """
+        Finds, for each center, the workers of the same picture within the
+        range of the picture. Workers are indexed by a uniform grid of cell
+        size the range, so that the candidates of a center are in the 3x3
+        cells around it. Distances are computed by vectorized blocks of
+        about block_size candidate pairs.
+        Centers with a null or missing coordinate have no neighbours.
+
+        Returns
+        -------
+        neighbours: list
+            indices of the workers within range of each center
+        """
+        neighbours = [np.zeros(0, dtype=int)] * len(centers)
+        valid = np.flatnonzero(
+            np.all(~np.isnan(centers) & (centers != 0), axis=1)
+        )
+        if len(valid) == 0 or len(workers) == 0:
+            return neighbours
+
+        cell_sizes = np.where(ranges > 0, ranges, 1)
+        worker_cells = np.floor(
+            workers / cell_sizes[worker_pictures, None]
+        ).astype(np.int64)
+        center_cells = np.floor(
+            centers[valid] / cell_sizes[center_pictures[valid], None]
+        ).astype(np.int64)
+        min_cell = np.minimum(worker_cells.min(axis=0),
+                              center_cells.min(axis=0)) - 1
+        worker_cells -= min_cell
+        center_cells -= min_cell
+        n_cells = np.maximum(worker_cells.max(axis=0),
+                             center_cells.max(axis=0)) + 2
+
+        def cell_keys(pictures, cells):
+            return (
+                (pictures * n_cells[0] + cells[:, 0]) * n_cells[1]
+                + cells[:, 1]
+            )
+
+        order = np.argsort(cell_keys(worker_pictures, worker_cells),
+                           kind='stable')
+        sorted_keys = cell_keys(worker_pictures, worker_cells)[order]
+
+        pairs = []
+        workers_by_picture = max(1, len(workers) // len(ranges))
+        block = max(1, block_size // 9 // workers_by_picture)
+        for start in range(0, len(valid), block):
+            queries = valid[start:start+block]
+            query_cells = center_cells[start:start+block]
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    keys = cell_keys(center_pictures[queries],
+                                     query_cells + [dx, dy])
+                    low = np.searchsorted(sorted_keys, keys, side='left')
+                    high = np.searchsorted(sorted_keys, keys, side='right')
+                    counts = high - low
+                    query_ids = np.repeat(queries, counts)
+                    candidates = order[
+                        np.repeat(low - np.cumsum(counts) + counts, counts)
+                        + np.arange(counts.sum())
+                    ]
+                    distances = np.sqrt(
+                        (workers[candidates, 0]-centers[query_ids, 0])**2
+                        + (workers[candidates, 1]-centers[query_ids, 1])**2
+                    )
+                    in_range = distances <= ranges[center_pictures[query_ids]]
+                    pairs.append((query_ids[in_range], candidates[in_range]))
+
+        query_ids = np.concatenate([pair[0] for pair in pairs])
+        candidates = np.concatenate([pair[1] for pair in pairs])
+        order = np.lexsort((candidates, query_ids))
+        query_ids, candidates = query_ids[order], candidates[order]
+        bounds = np.searchsorted(query_ids, np.arange(len(centers)+1))
+        for i in valid:
+            neighbours[i] = candidates[bounds[i]:bounds[i+1]]
+
+        return neighbours
+
+    @staticmethod
+    def _find_working_workers(pump_neighbours: np.array,
+                              workers_neighbours: List[np.array]) -> List[int]:
+        """
+        Finds the workers transitively within range of a pump, i.e. the
+        connected component of the pump, with a breadth-first search.
+        """
+        reached = set(pump_neighbours.tolist())
+        queue = list(reached)
+        while queue:
+            for j in workers_neighbours[queue.pop()].tolist():
+                if j not in reached:
+                    reached.add(j)
+                    queue.append(j)
+
+        return sorted(reached)
 
 if __name__=='__main__':
     WorkingWorkersPipeline().launch()
@@ -0,0 +1,196 @@
+import os
+import pickle
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from stores import BoxesStore
+from utils import (PolygonZones, draw_cropped_mask,
+                   get_date_from_picture_name, parallel_map)
+
+
+class ZoneOccupancyPipeline:
+    # Artifacts read and written, see project.Project
+    inputs = [
+        'intermediate_process/zones_processed.pickle',
+        'intermediate_process/boxes_store',
+    ]
+    outputs = [
+        'intermediate_process/workers_zones.pickle',
+        'output_csv/workers_by_zone_by_date.csv',
+    ]
+
+    def launch(self, n_jobs: int = 1, chunk_size: int = 16) -> None:
+        print('ZoneOccupancy launched')
+        zones, boxes = self.extract()
+        workers_zones = self.transform(zones, boxes, n_jobs, chunk_size)
+        self.load(workers_zones, self.create_zone_workers_df(workers_zones))
+        print('ZoneOccupancy ended\n')
+
+    @staticmethod
+    def extract() -> Tuple:
+        with open('intermediate_process/zones_processed.pickle', 'rb') as file:
+            zones_processed = pickle.load(file)
+        boxes_processed = BoxesStore()
+
+        return zones_processed, boxes_processed
+
+    @classmethod
+    def transform(cls,
+                  zones: dict,
+                  boxes: BoxesStore,
+                  n_jobs: int = 1,
+                  chunk_size: int = 16) -> dict:
+        """
+        Returns
+        -------
+        workers_zones: dict
+            for each picture,
+            'zone_types': types of zones of the picture
+            'foot_zones': boolean array (workers x zone types), True if the
+                foot point of the worker is in a zone of the type
+            'overlaps': array (workers x zone types) of the fraction of the
+                box of the worker covered by zones of the type
+        """
+        pictures = list(zones.keys())
+        workers = []
+        for picture in pictures:
+            try:
+                workers.append(boxes.get_boxes(picture, 'People'))
+            except KeyError:
+                workers.append(np.zeros((0, 4)))
+        workers_zones = parallel_map(cls._get_workers_zones,
+                                     [zones[picture] for picture in pictures],
+                                     workers,
+                                     n_jobs=n_jobs,
+                                     chunk_size=chunk_size)
+
+        return dict(zip(pictures, workers_zones))
+
+    @staticmethod
+    def load(workers_zones: dict, zone_workers_df: pd.DataFrame) -> None:
+        os.makedirs('intermediate_process', exist_ok=True)
+        with open('intermediate_process/workers_zones.pickle', 'wb') as f:
+            pickle.dump(workers_zones, f, protocol=pickle.HIGHEST_PROTOCOL)
+        output_folder = 'output_csv/'
+        os.makedirs(output_folder, exist_ok=True)
+        zone_workers_df.to_csv(f'{output_folder}workers_by_zone_by_date.csv')
+
+    ##################
+    # Helper methods #
+    ##################
+
+    @staticmethod
+    def create_zone_workers_df(workers_zones: dict) -> pd.DataFrame:
+        """
+        Number of workers standing on each type of zone, by date
+        """
+        workers_by_zone_by_date = {}
+        for picture, picture_zones in workers_zones.items():
+            if not picture.startswith('Analytics'):
+                continue
+            date = get_date_from_picture_name(picture)
+            workers_by_zone_by_date[date] = dict(zip(
+                picture_zones['zone_types'],
+                picture_zones['foot_zones'].sum(axis=0).tolist()
+            ))
+
+        return (
+            pd.DataFrame.from_dict(workers_by_zone_by_date, orient='index')
+            .fillna(0)
+            .astype(int)
+            .sort_index()
+        )
+
+    @classmethod
+    def _get_workers_zones(cls,
+                           zones_of_picture: tuple,
+                           workers: np.array) -> dict:
+        zones_by_type, height, width = zones_of_picture
+        zone_types = sorted(zones_by_type)
+        # Polygon zones are queried as vectors, only bitmaps are rasterized
+        is_vector = [
+            all(type(zone) is list for zone in zones_by_type[zone_type])
+            for zone_type in zone_types
+        ]
+        if all(is_vector):
+            labels = np.zeros((1, 1), dtype=np.int32)
+        else:
+            labels = cls._get_label_raster(
+                [[] if vector else zones_by_type[zone_type]
+                 for zone_type, vector in zip(zone_types, is_vector)],
+                height, width
+            )
+        workers = np.asarray(workers, dtype=float).reshape(-1, 4)
+        x_min = np.clip(np.minimum(workers[:, 0], workers[:, 2]), 0, width-1)
+        x_max = np.clip(np.maximum(workers[:, 0], workers[:, 2]), 0, width-1)
+        y_min = np.clip(np.minimum(workers[:, 1], workers[:, 3]), 0, height-1)
+        y_max = np.clip(np.maximum(workers[:, 1], workers[:, 3]), 0, height-1)
+        x_min, x_max, y_min, y_max = (
+            coord.astype(int) for coord in (x_min, x_max, y_min, y_max)
+        )
+
+        # The foot point of a worker is the middle of the bottom of its box
+        foot_labels = (
+            np.zeros(len(workers), dtype=np.int32) if all(is_vector)
+            else labels[y_max, (x_min + x_max) // 2]
+        )
+        bits = np.arange(len(zone_types))
+        foot_zones = (foot_labels[:, None] >> bits & 1).astype(bool)
+
+        overlaps = np.zeros((len(workers), len(zone_types)))
+        areas = (x_max - x_min + 1) * (y_max - y_min + 1)
+        for bit in bits:
+            if is_vector[bit]:
+                # Same pixels as the raster, only drawn on the boxes
+                polygons = PolygonZones(zones_by_type[zone_types[bit]])
+                for i in range(len(workers)):
+                    mask = polygons.draw_box(
+                        [x_min[i], y_min[i], x_max[i], y_max[i]], height, width
+                    )
+                    foot_zones[i, bit] = mask[-1, (x_max[i] - x_min[i]) // 2]
+                    overlaps[i, bit] = mask.sum() / areas[i]
+                continue
+            table = cls._get_summed_area_table((labels >> bit & 1))
+            overlaps[:, bit] = (
+                table[y_max+1, x_max+1] - table[y_min, x_max+1]
+                - table[y_max+1, x_min] + table[y_min, x_min]
+            ) / areas
+
+        return {'zone_types': zone_types,
+                'foot_zones': foot_zones,
+                'overlaps': overlaps}
+
+    @staticmethod
+    def _get_label_raster(zones_by_type: List[list],
+                          height: int,
+                          width: int) -> np.array:
+        """
+        Draws the zones of a picture in a single raster, where bit t of a
+        pixel is set if the pixel is in a zone of the t-th type.
+        """
+        labels = np.zeros((height, width), dtype=np.int32)
+        for bit, zones in enumerate(zones_by_type):
+            for zone in zones:
+                mask, (x, y) = draw_cropped_mask(zone, height, width)
+                labels[y:y+mask.shape[0], x:x+mask.shape[1]] |= (
+                    mask.astype(np.int32) << bit
+                )
+
+        return labels
+
+    @staticmethod
+    def _get_summed_area_table(mask: np.array) -> np.array:
+        """
+        table[i, j] is the number of pixels of mask in mask[:i, :j], so that
+        the number of pixels in any rectangle is computed in O(1).
+        """
+        table = np.zeros((mask.shape[0]+1, mask.shape[1]+1), dtype=np.int64)
+        table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+        return table
+
+
+if __name__ == '__main__':
+    ZoneOccupancyPipeline().launch()
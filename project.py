@@ -1,9 +1,272 @@
+import ast
+import glob
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional, Set
+
 from pipelines import pipelines
+from utils import get_artifact_hash, get_file_hash
+
+PROJECT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def _launch_pipeline(pipeline: type) -> None:
+    pipeline().launch()
+
 
 class Project:
-    def launch(self):
+    """
+    Runs the pipelines as a DAG: each pipeline declares the artifacts it
+    reads and writes (inputs and outputs, glob patterns of files or
+    folders), and depends on the last previous pipeline writing each of its
+    inputs. A pipeline is skipped when the content of its inputs and its
+    code, i.e. its module and the local modules it imports, are unchanged
+    since its last run and its outputs exist; the others run in a pool of
+    processes as soon as the pipelines they depend on are done, so that
+    independent pipelines run concurrently.
+
+    Artifacts that a pipeline reads and writes, e.g. boxes_processed.pickle
+    that both preprocessing pipelines merge into, may be updated again by
+    the next pipelines: running a pipeline again on its own output must
+    leave it unchanged, so their hashes are taken at the end of the run.
+
+    The hashes are kept in intermediate_process/stage_cache.json.
+    """
+
+    def launch(self,
+               n_jobs: int = 2,
+               force: bool = False,
+               cache_file: str = 'intermediate_process/stage_cache.json'
+               ) -> None:
+        start_time = time.time()
+        cache = self._read_cache(cache_file)
+        dependencies = self.get_dependencies(pipelines)
+        done, running = set(), {}
+        executor = None
+        try:
+            while len(done) < len(pipelines):
+                for i, pipeline in enumerate(pipelines):
+                    if i in done or i in running or not dependencies[i] <= done:
+                        continue
+                    input_hashes = self._get_input_hashes(pipeline, cache)
+                    if not force and self._is_cached(pipeline, input_hashes,
+                                                     cache['stages']):
+                        print(f'{pipeline.__name__} skipped\n')
+                        done.add(i)
+                        continue
+                    if executor is None:
+                        executor = ProcessPoolExecutor(max_workers=n_jobs)
+                    running[i] = (executor.submit(_launch_pipeline, pipeline),
+                                  input_hashes)
+                if not running:
+                    continue
+                finished, _ = wait([future for future, _ in running.values()],
+                                   return_when=FIRST_COMPLETED)
+                for i in [i for i, (future, _) in running.items()
+                          if future in finished]:
+                    future, input_hashes = running.pop(i)
+                    future.result()
+                    cache['stages'][pipelines[i].__name__] = (
+                        self._get_run_hashes(pipelines[i], input_hashes,
+                                             cache['files'])
+                    )
+                    done.add(i)
+            self._update_shared_hashes(pipelines, cache)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            self._write_cache(cache_file, cache)
+        print(f'Project ended in {time.time() - start_time:.2f}s')
+
+    @staticmethod
+    def get_dependencies(pipelines: List[type]) -> List[Set[int]]:
+        """
+        Returns, for each pipeline, the indices of the pipelines it depends
+        on: the last previous pipeline writing each of its inputs.
+        """
+        dependencies = []
+        for i, pipeline in enumerate(pipelines):
+            dependencies.append({
+                max(j for j in range(i)
+                    if artifact in getattr(pipelines[j], 'outputs', []))
+                for artifact in getattr(pipeline, 'inputs', [])
+                if any(artifact in getattr(pipelines[j], 'outputs', [])
+                       for j in range(i))
+            })
+
+        return dependencies
+
+    ##################
+    # Helper methods #
+    ##################
+
+    @staticmethod
+    def _get_input_hashes(pipeline: type, cache: dict) -> Dict[str, str]:
+        """
+        Hashes of the inputs and of the source files of a pipeline, None if
+        it does not declare its inputs.
+        """
+        if not hasattr(pipeline, 'inputs'):
+            return None
+        input_hashes = {
+            artifact: get_artifact_hash(artifact, cache['files'])
+            for artifact in pipeline.inputs
+        }
+        for source_file in Project._get_source_files(pipeline.__module__,
+                                                     cache):
+            input_hashes[source_file] = get_artifact_hash(source_file,
+                                                          cache['files'])
+
+        return input_hashes
+
+    @staticmethod
+    def _get_source_files(module_name: str, cache: dict) -> List[str]:
+        """
+        Source files of a module and of the local modules it imports,
+        directly or not. The names imported by each file are kept in
+        cache['imports'] with the hash of the file, so that unchanged files
+        are not parsed again.
+        """
+        source_files, names = set(), [module_name]
+        while names:
+            name = names.pop()
+            source_file = Project._get_local_source_file(name)
+            if source_file is None or source_file in source_files:
+                continue
+            source_files.add(source_file)
+            file_hash = get_file_hash(source_file, cache['files'])
+            cached = cache['imports'].get(source_file)
+            if cached is None or cached[0] != file_hash:
+                package = (name if source_file.endswith('__init__.py')
+                           else name.rpartition('.')[0])
+                cached = [file_hash,
+                          Project._get_imports(source_file, package)]
+                cache['imports'][source_file] = cached
+            names.extend(cached[1])
+
+        return sorted(source_files)
+
+    @staticmethod
+    def _get_imports(source_file: str, package: str) -> List[str]:
+        """
+        Absolute names of the modules imported by a source file, including
+        the names imported from a module, which may be its submodules.
+        """
+        with open(source_file) as file:
+            tree = ast.parse(file.read())
+        names = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    base = importlib.util.resolve_name(
+                        '.' * node.level + (node.module or ''), package
+                    )
+                else:
+                    base = node.module
+                if node.module is not None:
+                    names.append(base)
+                names.extend(f'{base}.{alias.name}' for alias in node.names)
+
+        return names
+
+    @staticmethod
+    def _get_local_source_file(name: str) -> Optional[str]:
+        """
+        Path of the source file of a module of the project folder, None for
+        other modules and for names that are not modules.
+        """
+        try:
+            # The top-level module is checked first, so that third-party
+            # packages are not imported to find their submodules
+            for module_name in [name.partition('.')[0], name]:
+                spec = importlib.util.find_spec(module_name)
+                if spec is None or spec.origin is None:
+                    return None
+                origin = os.path.abspath(spec.origin)
+                if (os.path.commonpath([origin, PROJECT_FOLDER])
+                        != PROJECT_FOLDER
+                        or 'site-packages' in origin
+                        or not origin.endswith('.py')):
+                    return None
+        except (ImportError, ValueError, AttributeError):
+            return None
+
+        return os.path.relpath(origin)
+
+    @staticmethod
+    def _is_cached(pipeline: type,
+                   input_hashes: Dict[str, str],
+                   stages: dict) -> bool:
+        return (
+            input_hashes is not None
+            and stages.get(pipeline.__name__) == input_hashes
+            and all(glob.glob(artifact)
+                    for artifact in getattr(pipeline, 'outputs', []))
+        )
+
+    @staticmethod
+    def _get_run_hashes(pipeline: type,
+                        input_hashes: Dict[str, str],
+                        file_hashes: dict) -> Dict[str, str]:
+        """
+        Hashes of the inputs of a pipeline to compare with at its next run.
+        Inputs that the pipeline also writes are hashed after its run.
+        """
+        if input_hashes is None:
+            return None
+
+        return {
+            artifact: (get_artifact_hash(artifact, file_hashes)
+                       if artifact in getattr(pipeline, 'outputs', [])
+                       else artifact_hash)
+            for artifact, artifact_hash in input_hashes.items()
+        }
+
+    @staticmethod
+    def _update_shared_hashes(pipelines: List[type], cache: dict) -> None:
+        """
+        Hashes, at the end of the run, of the artifacts that the pipelines
+        read and write, as the next pipelines may have updated them.
+        """
         for pipeline in pipelines:
-            pipeline().launch()
+            stage_hashes = cache['stages'].get(pipeline.__name__)
+            if stage_hashes is None:
+                continue
+            for artifact in getattr(pipeline, 'inputs', []):
+                if artifact in getattr(pipeline, 'outputs', []):
+                    stage_hashes[artifact] = get_artifact_hash(
+                        artifact, cache['files']
+                    )
+
+    @staticmethod
+    def _read_cache(cache_file: str) -> dict:
+        cache = {'files': {}, 'stages': {}, 'imports': {}}
+        if os.path.isfile(cache_file):
+            with open(cache_file) as file:
+                cache.update(json.load(file))
+
+        return cache
+
+    @staticmethod
+    def _write_cache(cache_file: str, cache: dict) -> None:
+        cache['files'] = {
+            path: file_hash for path, file_hash in cache['files'].items()
+            if os.path.isfile(path)
+        }
+        cache['imports'] = {
+            path: imports for path, imports in cache['imports'].items()
+            if path in cache['files']
+        }
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + '.tmp', 'w') as file:
+            json.dump(cache, file)
+        os.replace(cache_file + '.tmp', cache_file)
+
 
 if __name__=='__main__':
     Project().launch()
@@ -0,0 +1,805 @@
+import json
+import os
+import shutil
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from constants import SMOOTHING_HALF_WINDOW
+from utils import (decompress_mask, expand_mask, get_dates_from_picture_names,
+                   get_half_window, get_site_from_picture_name,
+                   rolling_time_window)
+
+
+def _make_tmp_folder(folder: str) -> str:
+    tmp_folder = folder.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    return tmp_folder
+
+def _replace_folder(tmp_folder: str, folder: str) -> None:
+    shutil.rmtree(folder, ignore_errors=True)
+    os.rename(tmp_folder, folder)
+
+def _save_columns(folder: str, columns: dict) -> None:
+    for column, values in columns.items():
+        np.save(os.path.join(folder, f'{column}.npy'), values)
+
+def _open_columns(store, folder: str, columns: List[str]) -> None:
+    for column in columns:
+        setattr(store, column, np.load(os.path.join(folder, f'{column}.npy'),
+                                       mmap_mode='r'))
+
+def _get_picture_index(pictures: np.array, picture: str) -> int:
+    index = int(np.searchsorted(pictures, picture))
+    if index == len(pictures) or pictures[index] != picture:
+        raise KeyError(picture)
+
+    return index
+
+
+class BoxesStore:
+    """
+    Columnar version of boxes_processed: a sorted table of pictures and
+    flat arrays of box coordinates and class ids, with per-picture offsets.
+    Every column is a .npy file opened as a memory map, so that opening the
+    store is immediate and only the columns and pictures used are read.
+
+    Files
+    -----
+    pictures.npy: picture names, sorted
+    heights.npy, widths.npy: size of each picture
+    offsets.npy: boxes of picture i are boxes[offsets[i]:offsets[i+1]]
+    boxes.npy: coordinates [x_min, y_min, x_max, y_max] of each box
+    class_ids.npy: index in classes.json of the class of each box
+    """
+
+    def __init__(self, folder: str = 'intermediate_process/boxes_store'):
+        self.folder = folder
+        with open(os.path.join(folder, 'classes.json')) as file:
+            self.classes = json.load(file)
+        _open_columns(self, folder, ['pictures', 'heights', 'widths',
+                                     'offsets', 'boxes', 'class_ids'])
+
+    @staticmethod
+    def save(boxes_processed: dict,
+             folder: str = 'intermediate_process/boxes_store') -> None:
+        pictures = sorted(boxes_processed)
+        classes = sorted({
+            class_name
+            for picture in pictures
+            for class_name in boxes_processed[picture][0]
+        })
+        class_ids_by_name = {name: i for i, name in enumerate(classes)}
+        boxes, class_ids, heights, widths = [], [], [], []
+        offsets = [0]
+        for picture in pictures:
+            objs, height, width = boxes_processed[picture]
+            for class_name, coords in objs.items():
+                boxes.extend(coords)
+                class_ids.extend([class_ids_by_name[class_name]]*len(coords))
+            offsets.append(len(boxes))
+            heights.append(height)
+            widths.append(width)
+
+        columns = {
+            'pictures': np.array(pictures, dtype=str),
+            'heights': np.array(heights, dtype=np.int32),
+            'widths': np.array(widths, dtype=np.int32),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'boxes': np.array(boxes).reshape(-1, 4),
+            'class_ids': np.array(class_ids, dtype=np.int16),
+        }
+        tmp_folder = _make_tmp_folder(folder)
+        _save_columns(tmp_folder, columns)
+        with open(os.path.join(tmp_folder, 'classes.json'), 'w') as file:
+            json.dump(classes, file)
+        _replace_folder(tmp_folder, folder)
+
+    def __len__(self) -> int:
+        return len(self.pictures)
+
+    def __contains__(self, picture: str) -> bool:
+        try:
+            self.get_index(picture)
+        except KeyError:
+            return False
+        return True
+
+    def get_index(self, picture: str) -> int:
+        return _get_picture_index(self.pictures, picture)
+
+    def get_size(self, picture: str) -> Tuple[int]:
+        index = self.get_index(picture)
+
+        return int(self.heights[index]), int(self.widths[index])
+
+    def get_boxes(self, picture: str, class_name: str = 'People') -> np.array:
+        """
+        Returns the boxes of a class in a picture as an array of shape (n, 4).
+        Raises a KeyError if the picture is not in the store.
+        """
+        index = self.get_index(picture)
+        start, end = self.offsets[index], self.offsets[index+1]
+        if class_name not in self.classes:
+            return np.array(self.boxes[start:start])
+        class_id = self.classes.index(class_name)
+
+        return np.array(
+            self.boxes[start:end][self.class_ids[start:end] == class_id]
+        )
+
+    def count_boxes(self, class_name: str = 'People') -> np.array:
+        """
+        Returns the number of boxes of a class in each picture, in the
+        order of self.pictures.
+        """
+        if class_name not in self.classes:
+            return np.zeros(len(self.pictures), dtype=np.int64)
+        picture_ids = np.repeat(np.arange(len(self.pictures)),
+                                np.diff(self.offsets))
+
+        return np.bincount(
+            picture_ids[self.class_ids == self.classes.index(class_name)],
+            minlength=len(self.pictures)
+        )
+
+    def to_dict(self) -> dict:
+        """
+        Rebuilds boxes_processed from the store.
+        """
+        boxes_processed = {}
+        for index, picture in enumerate(self.pictures):
+            start, end = self.offsets[index], self.offsets[index+1]
+            boxes = self.boxes[start:end].tolist()
+            class_ids = self.class_ids[start:end]
+            objs = {
+                class_name: [box for box, class_id in zip(boxes, class_ids)
+                             if class_id == i]
+                for i, class_name in enumerate(self.classes)
+            }
+            boxes_processed[str(picture)] = (
+                objs, int(self.heights[index]), int(self.widths[index])
+            )
+
+        return boxes_processed
+
+
+class MaskStore:
+    """
+    Store of the zones of zones_processed, written by
+    JsonPreprocessingAnalyticsPipeline in intermediate_process/zones_store,
+    or of the masks of ConcreteZonePipeline, written in
+    intermediate_process/mask_store. Each mask is cropped
+    to its bounding box and packed into bits (see utils.compress_mask);
+    all the bits are concatenated in a single file read as a memory map,
+    so that a mask is read without loading the others.
+
+    Files
+    -----
+    masks.bin: packed bits of every mask
+    pictures.npy: picture names, sorted
+    heights.npy, widths.npy: size of each picture
+    offsets.npy: masks of picture i are masks offsets[i] to offsets[i+1]
+    zone_type_ids.npy: index in zone_types.json of the type of each mask
+    origins.npy: (x, y) position of each cropped mask in its picture
+    shapes.npy: (height, width) of each cropped mask
+    bytes_offsets.npy: bits of mask j are between bytes bytes_offsets[j]
+        and bytes_offsets[j+1] of masks.bin
+    """
+
+    def __init__(self, folder: str = 'intermediate_process/zones_store'):
+        self.folder = folder
+        with open(os.path.join(folder, 'zone_types.json')) as file:
+            self.zone_types = json.load(file)
+        _open_columns(self, folder, ['pictures', 'heights', 'widths',
+                                     'offsets', 'zone_type_ids', 'origins',
+                                     'shapes', 'bytes_offsets'])
+        bits_file = os.path.join(folder, 'masks.bin')
+        if os.path.getsize(bits_file) == 0:
+            self.bits = np.zeros(0, dtype=np.uint8)
+        else:
+            self.bits = np.memmap(bits_file, dtype=np.uint8, mode='r')
+
+    @staticmethod
+    def save(masks: dict,
+             folder: str = 'intermediate_process/zones_store') -> None:
+        """
+        Parameter
+        ---------
+        masks: dict
+            (masks_by_type, height, width) of each picture, masks_by_type
+            giving the list of compressed masks of each zone type
+        """
+        pictures = sorted(masks)
+        zone_types = sorted({
+            zone_type
+            for picture in pictures
+            for zone_type in masks[picture][0]
+        })
+        zone_type_ids_by_name = {name: i for i, name in enumerate(zone_types)}
+        heights, widths, zone_type_ids, origins, shapes = [], [], [], [], []
+        offsets, bytes_offsets = [0], [0]
+        tmp_folder = _make_tmp_folder(folder)
+        with open(os.path.join(tmp_folder, 'masks.bin'), 'wb') as bits_file:
+            for picture in pictures:
+                masks_by_type, height, width = masks[picture]
+                for zone_type, zones in masks_by_type.items():
+                    for zone in zones:
+                        bits_file.write(zone['bits'].tobytes())
+                        bytes_offsets.append(
+                            bytes_offsets[-1] + zone['bits'].nbytes
+                        )
+                        zone_type_ids.append(zone_type_ids_by_name[zone_type])
+                        origins.append(zone['origin'])
+                        shapes.append(zone['shape'])
+                offsets.append(len(zone_type_ids))
+                heights.append(height)
+                widths.append(width)
+
+        _save_columns(tmp_folder, {
+            'pictures': np.array(pictures, dtype=str),
+            'heights': np.array(heights, dtype=np.int32),
+            'widths': np.array(widths, dtype=np.int32),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'zone_type_ids': np.array(zone_type_ids, dtype=np.int16),
+            'origins': np.array(origins, dtype=np.int32).reshape(-1, 2),
+            'shapes': np.array(shapes, dtype=np.int32).reshape(-1, 2),
+            'bytes_offsets': np.array(bytes_offsets, dtype=np.int64),
+        })
+        with open(os.path.join(tmp_folder, 'zone_types.json'), 'w') as file:
+            json.dump(zone_types, file)
+        _replace_folder(tmp_folder, folder)
+
+    @classmethod
+    def merge(cls,
+              masks: dict,
+              folder: str = 'intermediate_process/zones_store') -> None:
+        """
+        Same as save, the pictures of the store in folder that are not in
+        masks being kept: their masks are copied without being decoded.
+        """
+        store = cls(folder)
+        merged = {
+            picture: ({
+                zone_type: store.get_zones(picture, zone_type)
+                for zone_type in store.zone_types
+            }, int(height), int(width))
+            for picture, height, width in zip(store.pictures, store.heights,
+                                              store.widths)
+            if picture not in masks
+        }
+        merged.update(masks)
+        cls.save(merged, folder)
+
+    def __len__(self) -> int:
+        return len(self.pictures)
+
+    def __contains__(self, picture: str) -> bool:
+        try:
+            self.get_index(picture)
+        except KeyError:
+            return False
+        return True
+
+    def get_index(self, picture: str) -> int:
+        return _get_picture_index(self.pictures, picture)
+
+    def get_zones(self, picture: str, zone_type: str) -> List[dict]:
+        """
+        Returns the compressed masks of a type of zones in a picture.
+        Raises a KeyError if the picture is not in the store.
+        """
+        index = self.get_index(picture)
+        if zone_type not in self.zone_types:
+            return []
+        zone_type_id = self.zone_types.index(zone_type)
+        start, end = self.offsets[index], self.offsets[index+1]
+        mask_ids = start + np.flatnonzero(
+            self.zone_type_ids[start:end] == zone_type_id
+        )
+
+        return [self._get_zone(mask_id) for mask_id in mask_ids]
+
+    def get_mask(self,
+                 picture: str,
+                 zone_type: str,
+                 zone_index: int,
+                 full_frame: bool = True) -> np.array:
+        """
+        Returns a mask, on the full frame or cropped to its bounding box
+        """
+        zone = self.get_zones(picture, zone_type)[zone_index]
+        mask = decompress_mask(zone)
+        if not full_frame:
+            return mask
+        index = self.get_index(picture)
+
+        return expand_mask(mask, zone['origin'],
+                           int(self.heights[index]), int(self.widths[index]))
+
+    def _get_zone(self, mask_id: int) -> dict:
+        start, end = self.bytes_offsets[mask_id], self.bytes_offsets[mask_id+1]
+
+        return {'bits': self.bits[start:end],
+                'origin': tuple(int(x) for x in self.origins[mask_id]),
+                'shape': tuple(int(x) for x in self.shapes[mask_id])}
+
+
+class PictureIndex:
+    """
+    Index of the pictures by date, so that the pictures of a time range are
+    found by bisection instead of parsing the name of every picture.
+
+    Files
+    -----
+    dates.npy: dates of the pictures, sorted, datetime64[ns]
+    pictures.npy: picture names, in the order of the dates
+    """
+
+    def __init__(self, folder: str = 'intermediate_process/picture_index'):
+        self.folder = folder
+        _open_columns(self, folder, ['dates', 'pictures'])
+
+    @staticmethod
+    def save(pictures: List[str],
+             folder: str = 'intermediate_process/picture_index') -> None:
+        """
+        Parses the dates of the pictures once, pictures without date in
+        their name being left out.
+        """
+        pictures = np.array(sorted(set(pictures)), dtype=str)
+        dates = get_dates_from_picture_names(pictures)
+        order = np.argsort(dates[~np.isnat(dates)], kind='stable')
+        tmp_folder = _make_tmp_folder(folder)
+        _save_columns(tmp_folder, {
+            'dates': dates[~np.isnat(dates)][order],
+            'pictures': pictures[~np.isnat(dates)][order],
+        })
+        _replace_folder(tmp_folder, folder)
+
+    def __len__(self) -> int:
+        return len(self.pictures)
+
+    def get_pictures(self,
+                     start: pd.Timestamp,
+                     end: pd.Timestamp) -> Tuple[np.array]:
+        """
+        Returns the dates and names of the pictures with start <= date < end
+        """
+        first, last = np.searchsorted(self.dates, np.array(
+            [pd.Timestamp(start), pd.Timestamp(end)], dtype='datetime64[ns]'
+        ))
+
+        return (np.array(self.dates[first:last]),
+                np.array(self.pictures[first:last]))
+
+    def get_records(self,
+                    start: pd.Timestamp,
+                    end: pd.Timestamp,
+                    boxes: BoxesStore = None,
+                    masks: MaskStore = None,
+                    pump_key_points: dict = None) -> List[dict]:
+        """
+        Returns the records of the pictures with start <= date < end, in
+        the order of their dates. The sources that are not given are not
+        read, e.g. get_records(start, end, boxes=BoxesStore()).
+
+        Returns
+        -------
+        records: list
+            for each picture, a dict with its 'picture' and 'date', and
+            'boxes': boxes of each class, if boxes is given
+            'zones': compressed masks of each zone type, if masks is given
+            'pump': key points of the pump hoses, if pump_key_points is given
+        """
+        records = []
+        for date, picture in zip(*self.get_pictures(start, end)):
+            record = {'picture': str(picture), 'date': pd.Timestamp(date)}
+            if boxes is not None and picture in boxes:
+                record['boxes'] = {
+                    class_name: boxes.get_boxes(picture, class_name)
+                    for class_name in boxes.classes
+                }
+            if masks is not None and picture in masks:
+                record['zones'] = {
+                    zone_type: masks.get_zones(picture, zone_type)
+                    for zone_type in masks.zone_types
+                }
+            if pump_key_points is not None and picture in pump_key_points:
+                record['pump'] = pump_key_points[picture]
+            records.append(record)
+
+        return records
+
+
+class TimeSeriesStore:
+    """
+    Append-only store of a time series by picture date and of its smoothed
+    values (see utils.rolling_time_window), written as a CSV file unless
+    csv_file is None.
+    New pictures, and pictures whose value changed, only update the rows
+    whose smoothing window contains them, i.e. the tail of the series when
+    pictures arrive in order: the files are truncated at the first updated
+    row and the new rows are appended.
+    The sizes of the files are saved in state.json once an update is
+    written, so that a store left by an interrupted update is rebuilt.
+
+    Files
+    -----
+    state.json: smoothing parameters and CSV file of the series, and sizes
+        of the files of the store (None during an update)
+    picture_values.txt: 'picture\tvalue' lines of the pictures in the
+        series, appended at each update, the last line of a picture giving
+        its current value; compacted when half of its lines are outdated
+    dates.bin: dates of the rows, sorted, int64 nanoseconds
+    values.bin: value of each row, float64
+    smoothed.bin: smoothed value of each row, float64
+    csv_offsets.bin: byte offset of each row in the CSV file, int64 (0
+        without CSV file)
+    """
+
+    columns = {'dates': np.int64, 'values': np.float64,
+               'smoothed': np.float64, 'csv_offsets': np.int64}
+
+    def __init__(self,
+                 folder: str,
+                 csv_file: Optional[str],
+                 half_window: str = SMOOTHING_HALF_WINDOW,
+                 statistic: str = 'max',
+                 incremental: bool = True):
+        self.folder = folder
+        self.state = {'csv_file': csv_file,
+                      'half_window': str(get_half_window(half_window)),
+                      'statistic': statistic}
+        if not (incremental and self._is_valid()):
+            self._reset()
+        self.values_by_picture = {}
+        self.n_picture_lines = 0
+        with open(os.path.join(folder, 'picture_values.txt')) as file:
+            for line in file:
+                picture, value = line.rstrip('\n').split('\t')
+                self.values_by_picture[picture] = float(value)
+                self.n_picture_lines += 1
+
+    def __len__(self) -> int:
+        return os.path.getsize(self._path('dates')) // 8
+
+    def __contains__(self, picture: str) -> bool:
+        return picture in self.values_by_picture
+
+    def update(self, values_by_picture: dict) -> int:
+        """
+        Adds the values of new pictures and of the pictures whose value
+        changed, the others being ignored. A picture with the date of a row
+        replaces it.
+
+        Returns
+        -------
+        n_rows: int
+            number of rows rewritten
+        """
+        new_pictures = [
+            picture for picture, value in values_by_picture.items()
+            if self.values_by_picture.get(picture) != float(value)
+        ]
+        if not new_pictures:
+            return 0
+        new_dates = get_dates_from_picture_names(new_pictures).astype(np.int64)
+        new_values = np.array([values_by_picture[picture]
+                               for picture in new_pictures], dtype=float)
+
+        # Rows from first_updated on have updated pictures in their window,
+        # which needs the raw values from window_start on
+        dates = self._read('dates')
+        half_window = pd.Timedelta(self.state['half_window']).value
+        first_updated = int(np.searchsorted(
+            dates, new_dates.min() - half_window, side='left'
+        ))
+        window_start = int(np.searchsorted(
+            dates, new_dates.min() - 2*half_window, side='left'
+        ))
+        series = pd.concat([
+            pd.Series(self._read('values', window_start),
+                      index=dates[window_start:]),
+            pd.Series(new_values, index=new_dates),
+        ])
+        series = series[~series.index.duplicated(keep='last')]
+        series = series.iloc[np.argsort(series.index.values, kind='stable')]
+        smoothed = rolling_time_window(
+            series.values, series.index.values.astype('datetime64[ns]'),
+            self.state['half_window'], self.state['statistic']
+        )
+        updated = slice(first_updated - window_start, None)
+
+        self._write_state(sizes=None)
+        self._write('dates', first_updated, series.index.values[updated])
+        self._write('values', first_updated, series.values[updated])
+        self._write('smoothed', first_updated, smoothed[updated])
+        if self.state['csv_file'] is None:
+            self._write('csv_offsets', first_updated,
+                        np.zeros(len(smoothed[updated])))
+        else:
+            self._write_csv(first_updated, series.index.values[updated],
+                            smoothed[updated])
+        self.values_by_picture.update(zip(new_pictures, new_values.tolist()))
+        self._write_picture_values(new_pictures)
+        self._write_state(sizes=self._get_sizes())
+
+        return len(smoothed[updated])
+
+    def to_series(self) -> pd.Series:
+        """
+        Returns the smoothed series, indexed by date
+        """
+        return pd.Series(self._read('smoothed'),
+                         index=pd.to_datetime(self._read('dates')))
+
+    def get_dates(self, start: int = 0) -> np.array:
+        """
+        Returns the dates of the rows from the start-th on
+        """
+        return self._read('dates', start).astype('datetime64[ns]')
+
+    def get_range(self, start: pd.Timestamp, end: pd.Timestamp) -> Tuple:
+        """
+        Returns the dates, values and smoothed values of the rows with
+        start <= date < end
+        """
+        if len(self) == 0:
+            dates = np.zeros(0, dtype=np.int64)
+        else:
+            dates = np.memmap(self._path('dates'), dtype=np.int64, mode='r')
+        first, last = np.searchsorted(
+            dates, [pd.Timestamp(start).value, pd.Timestamp(end).value]
+        )
+
+        return (
+            np.array(dates[first:last]).astype('datetime64[ns]'),
+            self._read('values', first, last - first),
+            self._read('smoothed', first, last - first),
+        )
+
+    def _path(self, column: str) -> str:
+        return os.path.join(self.folder, f'{column}.bin')
+
+    def _read(self, column: str, start: int = 0, count: int = -1) -> np.array:
+        dtype = np.dtype(self.columns[column])
+        return np.fromfile(self._path(column), dtype=dtype, count=count,
+                           offset=start * dtype.itemsize)
+
+    def _write(self, column: str, start: int, values: np.array) -> None:
+        dtype = np.dtype(self.columns[column])
+        with open(self._path(column), 'r+b') as file:
+            file.truncate(start * dtype.itemsize)
+            file.seek(start * dtype.itemsize)
+            file.write(np.asarray(values).astype(dtype).tobytes())
+
+    def _write_csv(self,
+                   start: int,
+                   dates: np.array,
+                   smoothed: np.array) -> None:
+        # csv_offsets.bin still has the rows before the update
+        n_rows = os.path.getsize(self._path('csv_offsets')) // 8
+        csv_offset = (
+            int(self._read('csv_offsets', start, 1)[0]) if start < n_rows
+            else os.path.getsize(self.state['csv_file'])
+        )
+        rows = [
+            f'{pd.Timestamp(date)},{float(value)}\n'.encode()
+            for date, value in zip(dates, smoothed)
+        ]
+        self._write('csv_offsets', start, csv_offset + np.cumsum(
+            [0] + [len(row) for row in rows[:-1]], dtype=np.int64
+        ))
+        with open(self.state['csv_file'], 'r+b') as file:
+            file.truncate(csv_offset)
+            file.seek(csv_offset)
+            file.writelines(rows)
+
+    def _write_picture_values(self, pictures: List[str]) -> None:
+        """
+        Appends the values of pictures to picture_values.txt, or rewrites it
+        with one line by picture if half of its lines would be outdated.
+        """
+        path = os.path.join(self.folder, 'picture_values.txt')
+        if self.n_picture_lines + len(pictures) > 2*len(self.values_by_picture):
+            pictures, mode = list(self.values_by_picture), 'w'
+            path, self.n_picture_lines = path + '.tmp', 0
+        else:
+            mode = 'a'
+        with open(path, mode) as file:
+            file.writelines(f'{picture}\t{self.values_by_picture[picture]}\n'
+                            for picture in pictures)
+        self.n_picture_lines += len(pictures)
+        if mode == 'w':
+            os.replace(path, path[:-len('.tmp')])
+
+    def _get_sizes(self) -> dict:
+        sizes = {
+            file_name: os.path.getsize(os.path.join(self.folder, file_name))
+            for file_name in [*(f'{column}.bin' for column in self.columns),
+                              'picture_values.txt']
+        }
+        if self.state['csv_file'] is not None:
+            sizes['csv_file'] = os.path.getsize(self.state['csv_file'])
+
+        return sizes
+
+    def _write_state(self, sizes: Optional[dict], folder: str = None) -> None:
+        state_file = os.path.join(folder or self.folder, 'state.json')
+        with open(state_file + '.tmp', 'w') as file:
+            json.dump({**self.state, 'sizes': sizes}, file)
+        os.replace(state_file + '.tmp', state_file)
+
+    def _is_valid(self) -> bool:
+        """
+        Whether the store has the same parameters and its files have the
+        sizes saved at the end of the last update
+        """
+        state_file = os.path.join(self.folder, 'state.json')
+        if not os.path.isfile(state_file):
+            return False
+        with open(state_file) as file:
+            state = json.load(file)
+        sizes = state.pop('sizes', None)
+        if state != self.state or sizes is None:
+            return False
+        try:
+            return self._get_sizes() == sizes
+        except OSError:
+            return False
+
+    def _reset(self) -> None:
+        tmp_folder = _make_tmp_folder(self.folder)
+        for file_name in [*(f'{column}.bin' for column in self.columns),
+                          'picture_values.txt']:
+            open(os.path.join(tmp_folder, file_name), 'w').close()
+        self._write_state(sizes=None, folder=tmp_folder)
+        csv_file = self.state['csv_file']
+        if csv_file is not None:
+            os.makedirs(os.path.dirname(csv_file) or '.', exist_ok=True)
+            with open(csv_file, 'w') as file:
+                file.write(',0\n')
+        _replace_folder(tmp_folder, self.folder)
+        self._write_state(sizes=self._get_sizes())
+
+
+class PartitionedTimeSeries:
+    """
+    Time series by site (see utils.get_site_from_picture_name), saved as
+    columnar partitions by site and day, so that a date range is read
+    without touching the rest of the history. The series of each site is
+    kept in a TimeSeriesStore, and an update only rewrites the partitions
+    of the days of its updated rows.
+
+    Files
+    -----
+    folder/site=<site>/day=<YYYY-MM-DD>/: a partition, with the columns
+        date.npy: dates of the pictures, datetime64[ns]
+        count.npy: value of each picture, int64
+        smoothed.npy: smoothed value of each picture, float64
+    stores_folder/<site>/: TimeSeriesStore of each site
+    """
+
+    def __init__(self,
+                 folder: str,
+                 stores_folder: str,
+                 half_window: str = SMOOTHING_HALF_WINDOW,
+                 statistic: str = 'max',
+                 incremental: bool = True):
+        self.folder = folder
+        self.stores_folder = stores_folder
+        self.smoothing = {'half_window': half_window, 'statistic': statistic}
+        if not incremental:
+            shutil.rmtree(folder, ignore_errors=True)
+            shutil.rmtree(stores_folder, ignore_errors=True)
+        os.makedirs(stores_folder, exist_ok=True)
+        self.stores = {
+            site: TimeSeriesStore(os.path.join(stores_folder, site), None,
+                                  **self.smoothing)
+            for site in os.listdir(stores_folder)
+            if not site.endswith('.tmp')
+        }
+
+    def __contains__(self, picture: str) -> bool:
+        site = get_site_from_picture_name(picture)
+
+        return site in self.stores and picture in self.stores[site]
+
+    def update(self, values_by_picture: dict) -> int:
+        """
+        Adds the values of new pictures and of the pictures whose value
+        changed, and rewrites the partitions of the updated rows.
+
+        Returns
+        -------
+        n_partitions: int
+            number of partitions rewritten
+        """
+        values_by_site = {}
+        for picture, value in values_by_picture.items():
+            site = get_site_from_picture_name(picture)
+            values_by_site.setdefault(site, {})[picture] = value
+
+        n_partitions = 0
+        for site, values in values_by_site.items():
+            if site not in self.stores:
+                self.stores[site] = TimeSeriesStore(
+                    os.path.join(self.stores_folder, site), None,
+                    **self.smoothing
+                )
+            store = self.stores[site]
+            n_rows = store.update(values)
+            if n_rows == 0:
+                continue
+            updated_dates = store.get_dates(len(store) - n_rows)
+            for day in np.unique(updated_dates.astype('datetime64[D]')):
+                dates, counts, smoothed = store.get_range(
+                    day, day + np.timedelta64(1, 'D')
+                )
+                tmp_folder = _make_tmp_folder(self._get_partition(site, day))
+                _save_columns(tmp_folder, {
+                    'date': dates,
+                    'count': counts.astype(np.int64),
+                    'smoothed': smoothed,
+                })
+                _replace_folder(tmp_folder, self._get_partition(site, day))
+                n_partitions += 1
+
+        return n_partitions
+
+    @staticmethod
+    def load(folder: str,
+             start: pd.Timestamp,
+             end: pd.Timestamp,
+             sites: List[str] = None) -> pd.DataFrame:
+        """
+        Reads the rows of the partitions with start <= date < end, only
+        opening the partitions of the days of the range.
+
+        Returns
+        -------
+        df: pd.DataFrame
+            columns site, date, count and smoothed, sorted by site and date
+        """
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        frames = []
+        site_folders = sorted(
+            site_folder for site_folder in os.listdir(folder)
+            if site_folder.startswith('site=')
+        ) if os.path.isdir(folder) else []
+        for site_folder in site_folders:
+            site = site_folder[len('site='):]
+            if sites is not None and site not in sites:
+                continue
+            for day_folder in sorted(os.listdir(os.path.join(folder,
+                                                             site_folder))):
+                if not day_folder.startswith('day='):
+                    continue
+                day = pd.Timestamp(day_folder[len('day='):])
+                if not start.floor('D') <= day < end:
+                    continue
+                path = os.path.join(folder, site_folder, day_folder)
+                frame = pd.DataFrame({
+                    column: np.load(os.path.join(path, f'{column}.npy'))
+                    for column in ['date', 'count', 'smoothed']
+                })
+                frame.insert(0, 'site', site)
+                frames.append(
+                    frame[(frame['date'] >= start) & (frame['date'] < end)]
+                )
+        if not frames:
+            return pd.DataFrame({
+                'site': pd.Series([], dtype=object),
+                'date': pd.Series([], dtype='datetime64[ns]'),
+                'count': pd.Series([], dtype=np.int64),
+                'smoothed': pd.Series([], dtype=np.float64),
+            })
+
+        return pd.concat(frames, ignore_index=True)
+
+    def _get_partition(self, site: str, day: np.datetime64) -> str:
+        return os.path.join(self.folder, f'site={site}', f'day={day}')
@@ -1,11 +1,27 @@
 import base64
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import glob
+import hashlib
+import os
+import pickle
+import re
+import threading
 import zlib
-from typing import List, Union
+from typing import Callable, Dict, List, Match, Optional, Tuple, Union
 
 import cv2
 import numpy as np
+import pandas as pd
 from PIL import Image, ImageDraw
+from shapely.geometry import LineString, MultiPoint, Point, Polygon, box
+from shapely.ops import polygonize, unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from constants import MASK_CACHE_FOLDER, MASK_CACHE_MAX_BYTES
 
 
 def get_typical_size(workers: List[List[int]]) -> int:
@@ -33,6 +49,128 @@ def get_typical_size(workers: List[List[int]]) -> int:
     
     return size
 
+def split_in_chunks(items: list, n_chunks: int) -> List[list]:
+    """
+    Splits a list into at most n_chunks interleaved chunks of similar size,
+    e.g. to share files among a pool of workers.
+    """
+    n_chunks = max(1, min(n_chunks, len(items)))
+    return [items[i::n_chunks] for i in range(n_chunks)]
+
+def parallel_map(function: Callable,
+                 *iterables,
+                 n_jobs: int = 1,
+                 chunk_size: int = 16) -> list:
+    """
+    Same as list(map(function, *iterables)), computed by a pool of n_jobs
+    processes receiving chunk_size items at a time. Results are returned
+    in the order of the inputs.
+    """
+    if n_jobs <= 1:
+        return list(map(function, *iterables))
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(function, *iterables, chunksize=chunk_size))
+
+def get_changed_files(files: List[str],
+                      fingerprints: dict) -> Dict[str, Tuple[int]]:
+    """
+    Compares files to the fingerprints (modification time and size)
+    recorded when they were last processed.
+
+    Parameters
+    ----------
+    files: list
+        paths of the files
+    fingerprints: dict
+        fingerprint of each file already processed
+
+    Returns
+    -------
+    changed: dict
+        fingerprint of each new or modified file
+    """
+    changed = {}
+    for file in files:
+        stat = os.stat(file)
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        if fingerprints.get(file) != fingerprint:
+            changed[file] = fingerprint
+
+    return changed
+
+def save_fingerprints(fingerprints: dict,
+                      fingerprints_file: str,
+                      data_files: List[str]) -> None:
+    """
+    Saves the fingerprints of the processed files (see get_changed_files)
+    with those of the data files built from them, which must be written
+    first, see load_fingerprints.
+    """
+    with open(fingerprints_file, 'wb') as file:
+        pickle.dump({'fingerprints': fingerprints,
+                     'data_files': get_changed_files(data_files, {})},
+                    file, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_fingerprints(fingerprints_file: str, data_files: List[str]) -> dict:
+    """
+    Loads the fingerprints saved with save_fingerprints. They are ignored,
+    so that every file is processed again, if the data files are missing
+    or were modified since, as they would no longer hold the processed
+    files.
+    """
+    if not os.path.isfile(fingerprints_file):
+        return {}
+    with open(fingerprints_file, 'rb') as file:
+        saved = pickle.load(file)
+    if not (all(os.path.isfile(data_file) for data_file in data_files)
+            and 'data_files' in saved
+            and saved['data_files'] == get_changed_files(data_files, {})):
+        print(f'{fingerprints_file} does not match {", ".join(data_files)}, '
+              'all the files are processed again')
+        return {}
+
+    return saved['fingerprints']
+
+def get_file_hash(path: str, file_hashes: dict) -> str:
+    """
+    SHA-1 of the content of a file. Hashes are cached in file_hashes with
+    the modification time and size of the files, so that unchanged files
+    are not read again.
+    """
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached is not None and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+        return cached[2]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(2**20), b''):
+            sha1.update(chunk)
+    file_hashes[path] = [stat.st_mtime_ns, stat.st_size, sha1.hexdigest()]
+
+    return sha1.hexdigest()
+
+def get_artifact_hash(pattern: str, file_hashes: dict) -> Optional[str]:
+    """
+    Hash of the content of the files matching a glob pattern, the files of
+    matching folders included (see get_file_hash). None if nothing matches.
+    """
+    paths = []
+    for match in glob.glob(pattern):
+        if os.path.isdir(match):
+            paths.extend(
+                os.path.join(root, file)
+                for root, _, files in os.walk(match) for file in files
+            )
+        else:
+            paths.append(match)
+    if not paths:
+        return None
+    sha1 = hashlib.sha1()
+    for path in sorted(paths):
+        sha1.update(f'{path}\0{get_file_hash(path, file_hashes)}\n'.encode())
+
+    return sha1.hexdigest()
+
 def draw_mask(zone: Union[dict, list], height: int, width: int) -> np.array:
     if type(zone) is list:
         return draw_mask_from_list(zone, height, width)
@@ -40,17 +178,437 @@ def draw_mask(zone: Union[dict, list], height: int, width: int) -> np.array:
         return draw_mask_from_dict(zone, height, width)
 
 def draw_mask_from_list(zone: list, height: int, width: int) -> np.array:
-    img = Image.new('L', (width, height), 0)
-    ImageDraw.Draw(img).polygon([tuple(coord) for coord in zone], outline=1, fill=1)
-    
-    return np.array(img)
+    return expand_mask(*draw_cropped_mask_from_list(zone, height, width),
+                       height, width)
 
 def draw_mask_from_dict(zone: dict, height: int, width: int) -> np.array:
-    return base64_2_mask(zone['data'])
+    """
+    Draws a bitmap zone on the full frame, at the position given by its
+    origin. The zone is either a raw bitmap from a labelling JSON or a
+    compressed mask from bitmap_2_compressed_mask.
+    """
+    return expand_mask(*draw_cropped_mask_from_dict(zone, height, width),
+                       height, width)
+
+def draw_cropped_mask(zone: Union[dict, list],
+                      height: int,
+                      width: int) -> Tuple[np.array, Tuple[int]]:
+    """
+    Same as draw_mask, but only draws the part of the frame covered by
+    the zone.
+
+    Returns
+    -------
+    mask: np.array
+        mask of the zone, cropped to the frame
+    origin: tuple
+        (x, y) position of the top-left corner of mask in the frame
+    """
+    if type(zone) is list:
+        return draw_cropped_mask_from_list(zone, height, width)
+    elif type(zone) is dict:
+        return draw_cropped_mask_from_dict(zone, height, width)
+
+def draw_cropped_masks(zones: List[Union[dict, list]],
+                       height: int,
+                       width: int) -> List[Tuple[np.array, Tuple[int]]]:
+    """
+    Draws all the zones of a picture with draw_cropped_mask
+    """
+    return [draw_cropped_mask(zone, height, width) for zone in zones]
+
+def draw_cropped_mask_from_list(
+    zone: list, height: int, width: int
+) -> Tuple[np.array, Tuple[int]]:
+    """
+    Rasterizes a polygon on its bounding box only, clipped to the frame
+    """
+    points = np.asarray(zone, dtype=float).reshape(-1, 2)
+    if len(points) == 0:
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+    x_min, y_min = np.maximum(np.floor(points.min(axis=0)), 0).astype(int)
+    x_max = min(int(np.ceil(points[:, 0].max())), width - 1)
+    y_max = min(int(np.ceil(points[:, 1].max())), height - 1)
+    if x_max < x_min or y_max < y_min:
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+    img = Image.new('L', (x_max - x_min + 1, y_max - y_min + 1), 0)
+    ImageDraw.Draw(img).polygon(
+        [(coord[0] - x_min, coord[1] - y_min) for coord in zone],
+        outline=1, fill=1
+    )
+
+    return np.array(img), (int(x_min), int(y_min))
+
+def draw_cropped_mask_from_dict(
+    zone: dict, height: int, width: int
+) -> Tuple[np.array, Tuple[int]]:
+    if 'bits' in zone:
+        mask = decompress_mask(zone)
+    else:
+        mask = base64_2_mask(zone['data'])
+
+    return crop_to_frame(mask, zone.get('origin', (0, 0)), height, width)
+
+class PolygonZones:
+    """
+    Polygon zones of a picture kept as vector geometries, indexed by an
+    STRtree, so that they can be queried without being rasterized.
+
+    Parameter
+    ---------
+    zones: list
+        zones given as lists of [x, y] points
+    """
+
+    def __init__(self, zones: List[list]):
+        self.zones = zones
+        self.polygons = [self._to_polygon(zone) for zone in zones]
+        self.prepared = [prep(polygon) for polygon in self.polygons]
+        self.tree = STRtree(self.polygons)
+        self._indices = {
+            id(polygon): i for i, polygon in enumerate(self.polygons)
+        }
+        self._masks = {}
+
+    def __len__(self) -> int:
+        return len(self.polygons)
+
+    def contains(self, x: float, y: float) -> List[int]:
+        """
+        Returns the indices of the zones containing the point (x, y)
+        """
+        point = Point(x, y)
+        return [
+            i for i in self._query(point)
+            if self.prepared[i].intersects(point)
+        ]
+
+    def nearest(self, x: float, y: float) -> int:
+        """
+        Returns the index of the zone nearest to the point (x, y)
+        """
+        if len(self.polygons) == 0:
+            return None
+        nearest = self.tree.nearest(Point(x, y))
+        return self._to_indices([nearest])[0]
+
+    def overlap(self, box_coords: List[float]) -> float:
+        """
+        Returns the fraction of the box [x_min, y_min, x_max, y_max]
+        covered by the zones
+        """
+        rectangle = box(*box_coords)
+        if rectangle.area == 0:
+            return float(len(self.contains(box_coords[0], box_coords[1])) > 0)
+        intersections = [
+            self.polygons[i].intersection(rectangle)
+            for i in self._query(rectangle)
+            if self.prepared[i].intersects(rectangle)
+        ]
+        if len(intersections) == 0:
+            return 0.
+        return unary_union(intersections).area / rectangle.area
+
+    def draw_box(self,
+                 box_coords: List[int],
+                 height: int,
+                 width: int) -> np.array:
+        """
+        Draws the zones on the pixels of the box [x_min, y_min, x_max, y_max]
+        of the frame only, bounds included, as draw_mask would on the full
+        frame, so that polygon and bitmap zones give the same results. The
+        zones are drawn on their bounding box once, when first queried.
+        """
+        x_min, y_min, x_max, y_max = box_coords
+        mask = np.zeros((y_max - y_min + 1, x_max - x_min + 1), dtype=bool)
+        # The pixels of the outline of a zone may be out of its polygon
+        for i in self._query(box(x_min - 1, y_min - 1, x_max + 1, y_max + 1)):
+            if i not in self._masks:
+                self._masks[i] = draw_cropped_mask_from_list(self.zones[i],
+                                                             height, width)
+            zone_mask, (x, y) = self._masks[i]
+            left, top = max(x, x_min), max(y, y_min)
+            right = min(x + zone_mask.shape[1], x_max + 1)
+            bottom = min(y + zone_mask.shape[0], y_max + 1)
+            if left < right and top < bottom:
+                mask[top-y_min:bottom-y_min, left-x_min:right-x_min] |= (
+                    zone_mask[top-y:bottom-y, left-x:right-x].astype(bool)
+                )
+
+        return mask
+
+    def get_key_points(self, i: int, height: int, width: int) -> dict:
+        """
+        Same key points as ConcretePumpPipeline._get_pump_key_points,
+        computed on the vertices of the i-th zone clipped to the pixels of
+        the frame. The area is the number of pixels of the rasterized zone,
+        as for bitmap zones.
+        """
+        polygon = self.polygons[i].intersection(box(0, 0, width-1, height-1))
+        if polygon.is_empty:
+            return {'extremity': (None, None), 'centroid': (None, None),
+                    'bbox': None, 'area': 0}
+        points = self._get_vertices(polygon)
+        last_row = points[:, 1].max()
+        centroid = polygon.centroid
+        x_min, y_min, x_max, y_max = polygon.bounds
+        mask, _ = draw_cropped_mask_from_list(self.zones[i], height, width)
+
+        return {
+            'extremity': (
+                int(round(points[points[:, 1] == last_row, 0].mean())),
+                int(round(last_row))
+            ),
+            'centroid': np.array([centroid.y, centroid.x]),
+            'bbox': [int(np.floor(x_min)), int(np.floor(y_min)),
+                     int(np.ceil(x_max)), int(np.ceil(y_max))],
+            'area': int(np.count_nonzero(mask)),
+        }
+
+    def _query(self, geometry) -> List[int]:
+        return self._to_indices(self.tree.query(geometry))
+
+    def _to_indices(self, results) -> List[int]:
+        # shapely < 2 returns geometries, shapely >= 2 returns indices
+        return [
+            int(result) if isinstance(result, (int, np.integer))
+            else self._indices[id(result)]
+            for result in results
+        ]
+
+    @classmethod
+    def _get_vertices(cls, geometry) -> np.array:
+        if hasattr(geometry, 'geoms'):
+            return np.concatenate([
+                cls._get_vertices(part) for part in geometry.geoms
+            ])
+        if geometry.geom_type == 'Polygon':
+            return np.array(geometry.exterior.coords)
+        return np.array(geometry.coords)
+
+    @staticmethod
+    def _to_polygon(zone: list):
+        coords = [tuple(coord) for coord in zone]
+        if len(coords) < 3:
+            return MultiPoint(coords).convex_hull
+        polygon = Polygon(coords)
+        if polygon.is_valid:
+            return polygon
+        # Self-intersecting outline: all the faces it encloses are kept, as
+        # when it is rasterized, while buffer(0) would drop some of them
+        faces = unary_union(list(polygonize(
+            unary_union(LineString(coords + coords[:1]))
+        )))
+        return faces if not faces.is_empty else polygon.buffer(0)
+
+
+class Heatmap:
+    """
+    Mergeable 2D histogram of points of pictures of any size: each point is
+    binned by its position relative to the height and width of its picture,
+    so that counts[i, j] is the number of points in the cell of row i and
+    column j of the frame (rows from top to bottom, as in the pictures).
+    """
+
+    def __init__(self, bins: Tuple[int] = (128, 160)):
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def add(self, points: List[Tuple[int]], height: int, width: int) -> None:
+        """
+        Adds the (x, y) points of a picture, missing coordinates (None) and
+        points out of the frame being ignored.
+        """
+        points = np.array(
+            [[np.nan if coord is None else coord for coord in point]
+             for point in points], dtype=float
+        ).reshape(-1, 2)
+        in_frame = (
+            (points[:, 0] >= 0) & (points[:, 0] <= width)
+            & (points[:, 1] >= 0) & (points[:, 1] <= height)
+        )
+        n_rows, n_cols = self.counts.shape
+        rows = np.minimum(
+            (points[in_frame, 1] * n_rows / height).astype(int), n_rows - 1
+        )
+        cols = np.minimum(
+            (points[in_frame, 0] * n_cols / width).astype(int), n_cols - 1
+        )
+        self.counts += np.bincount(
+            rows * n_cols + cols, minlength=n_rows * n_cols
+        ).reshape(self.counts.shape)
+
+    def merge(self, other: 'Heatmap') -> 'Heatmap':
+        self.counts += other.counts
+
+        return self
+
+    def save(self, path: str) -> None:
+        np.save(path, self.counts)
+
+    @classmethod
+    def load(cls, path: str) -> 'Heatmap':
+        counts = np.load(path)
+        heatmap = cls(counts.shape)
+        heatmap.counts += counts
+
+        return heatmap
+
+
+def compress_mask(mask: np.array, origin: Tuple[int] = (0, 0)) -> dict:
+    """
+    Crops a binary mask to its non-empty part and packs it into bits
+
+    Parameters
+    ----------
+    mask: np.array
+        binary mask
+    origin: tuple
+        (x, y) position of the top-left corner of mask in the frame
+
+    Returns
+    -------
+    zone: dict
+        'bits': packed pixels of the cropped mask
+        'origin': (x, y) position of the cropped mask in the frame
+        'shape': (height, width) of the cropped mask
+    """
+    mask = np.asarray(mask).astype(bool)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        mask = mask[:0, :0]
+    else:
+        mask = mask[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+        origin = (origin[0] + cols[0], origin[1] + rows[0])
+
+    return {'bits': np.packbits(mask),
+            'origin': (int(origin[0]), int(origin[1])),
+            'shape': mask.shape}
+
+def bitmap_2_compressed_mask(bitmap: dict) -> dict:
+    """
+    Decodes a bitmap of a labelling JSON into a compressed mask
+    (see compress_mask), so that it is decoded only once. Each bitmap is
+    decoded once at ingest, so mask_cache is not used.
+    """
+    return compress_mask(_decode_base64_mask(bitmap['data']), bitmap['origin'])
+
+def decompress_mask(zone: dict) -> np.array:
+    """
+    Unpacks the cropped mask of a zone compressed with compress_mask
+    """
+    height, width = zone['shape']
+    return (
+        np.unpackbits(zone['bits'], count=height*width)
+        .reshape(height, width)
+        .astype(bool)
+    )
+
+def expand_mask(mask: np.array,
+                origin: Tuple[int],
+                height: int,
+                width: int) -> np.array:
+    """
+    Places a cropped mask at its origin in an empty frame of size
+    height x width. Parts of the mask outside of the frame are dropped.
+    """
+    frame = np.zeros((height, width), dtype=np.uint8)
+    mask, (x, y) = crop_to_frame(mask, origin, height, width)
+    frame[y:y+mask.shape[0], x:x+mask.shape[1]] = mask
+
+    return frame
+
+def crop_to_frame(mask: np.array,
+                  origin: Tuple[int],
+                  height: int,
+                  width: int) -> Tuple[np.array, Tuple[int]]:
+    """
+    Drops the parts of a mask placed at origin that are outside of a
+    frame of size height x width, and returns the new origin
+    """
+    x, y = origin
+    mask = mask[max(0, -y):max(0, height-y), max(0, -x):max(0, width-x)]
+
+    return mask, (max(0, x), max(0, y))
+
+class MaskCache:
+    """
+    Cache of the masks decoded from bitmap strings, keyed by a hash of the
+    string. Masks are kept in memory up to max_bytes, least recently used
+    first out, and optionally saved in folder to be reused by other runs.
+    Bitmaps are decoded once at ingest (see bitmap_2_compressed_mask), so
+    the cache only serves legacy zones saved without 'bits'.
+    """
+
+    def __init__(self, max_bytes: int = MASK_CACHE_MAX_BYTES,
+                 folder: str = MASK_CACHE_FOLDER):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.masks = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, s: str) -> np.array:
+        key = hashlib.sha1(s.encode()).hexdigest()
+        with self.lock:
+            if key in self.masks:
+                self.hits += 1
+                self.masks.move_to_end(key)
+                return self.masks[key]
+        path = (
+            os.path.join(self.folder, f'{key}.npy')
+            if self.folder is not None else None
+        )
+        if path is not None and os.path.isfile(path):
+            mask = np.load(path)
+            with self.lock:
+                self.disk_hits += 1
+        else:
+            mask = _decode_base64_mask(s)
+            with self.lock:
+                self.misses += 1
+            if path is not None:
+                # Written aside first, as other processes may read the file
+                os.makedirs(self.folder, exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as file:
+                    np.save(file, mask)
+                os.replace(tmp_path, path)
+        mask.flags.writeable = False
+        self._add(key, mask)
+
+        return mask
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'size': self.size}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.masks.clear()
+            self.size = 0
+
+    def _add(self, key: str, mask: np.array) -> None:
+        with self.lock:
+            if key in self.masks or mask.nbytes > self.max_bytes:
+                return
+            self.masks[key] = mask
+            self.size += mask.nbytes
+            while self.size > self.max_bytes:
+                _, removed = self.masks.popitem(last=False)
+                self.size -= removed.nbytes
+
+
+mask_cache = MaskCache()
 
 def base64_2_mask(s: str) -> np.array:
     """ 
-    Suggested method from eleven to convert a bitmap into an array
+    Suggested method from eleven to convert a bitmap into an array.
+    Decoded masks are cached in mask_cache: they are read-only. Only used
+    for legacy zones without 'bits', see bitmap_2_compressed_mask.
     
     Parameter
     ---------
@@ -60,12 +618,149 @@ def base64_2_mask(s: str) -> np.array:
     Returns
     -------
     mask: np.array
-        corresponding mask converted into an array
+        corresponding boolean mask converted into an array
     """
+    return mask_cache.get(s)
+
+def _decode_base64_mask(s: str) -> np.array:
     z = zlib.decompress(base64.b64decode(s))
-    n = np.fromstring(z, np.uint8)
+    n = np.frombuffer(z, np.uint8)
     
-    return cv2.imdecode(n, cv2.IMREAD_UNCHANGED)[:, :, 3].astype(bool) * 1
+    return cv2.imdecode(n, cv2.IMREAD_UNCHANGED)[:, :, 3].astype(bool)
+
+# Date of a picture, the last one in its name, e.g. 2020-05-12-09-00-03
+PICTURE_DATE_PATTERN = r'^(.*)(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})'
+PICTURE_DATE_FORMAT = '%Y-%m-%d-%H-%M-%S'
+
+def _match_picture_name(picture: str) -> Match:
+    match = re.match(PICTURE_DATE_PATTERN, os.path.basename(picture))
+    if match is None:
+        raise ValueError(f'no date in the name of picture {picture}')
+
+    return match
 
 def get_date_from_picture_name(picture: str) -> datetime:
-    return datetime.strptime(picture[-28:], '%Y-%m-%d-%H-%M-%S.jpg.json')
\ No newline at end of file
+    return datetime.strptime(_match_picture_name(picture).group(2),
+                             PICTURE_DATE_FORMAT)
+
+def get_dates_from_picture_names(pictures: List[str]) -> np.array:
+    """
+    Vectorized get_date_from_picture_name: dates of the pictures as a
+    datetime64[ns] array, NaT for names without date.
+    """
+    dates = (
+        pd.Series(pictures, dtype=object)
+        .str.extract(PICTURE_DATE_PATTERN, expand=True)[1]
+    )
+
+    return pd.to_datetime(dates, format=PICTURE_DATE_FORMAT).values
+
+def get_site_from_picture_name(picture: str) -> str:
+    """
+    Site (camera) of a picture: the prefix of its file name before the date,
+    'default' if there is none.
+    """
+    return _match_picture_name(picture).group(1).rstrip('_-') or 'default'
+
+def get_half_window(half_window: Union[str, pd.Timedelta]) -> pd.Timedelta:
+    """
+    Converts a half window to a duration. Numbers are rejected: they were
+    numbers of frames before the windows became durations, and
+    pd.Timedelta would read them as nanoseconds, i.e. no smoothing.
+    """
+    if isinstance(half_window, (int, float, np.number)):
+        raise TypeError(
+            f'half_window must be a duration, e.g. \'10min\', not the number '
+            f'of frames {half_window!r}'
+        )
+
+    return pd.Timedelta(half_window)
+
+def rolling_time_window(values: np.array,
+                        times: np.array,
+                        half_window: Union[str, pd.Timedelta],
+                        statistic: str = 'max',
+                        q: float = 0.5) -> np.array:
+    """
+    Centered rolling statistic over a time window: result[i] is computed
+    over the values whose time is within half_window of times[i], so that
+    gaps in the capture do not stretch the window.
+
+    Parameters
+    ----------
+    values: np.array
+        values of the series
+    times: np.array
+        sorted datetimes of the values
+    half_window: str or pd.Timedelta
+        half duration of the window, e.g. '10min'
+    statistic: str
+        'max' (monotonic deque, O(n)), 'median' or 'quantile' (sorted
+        window, O(n log w) comparisons)
+    q: float
+        quantile, for statistic='quantile'
+    """
+    values = np.asarray(values, dtype=float)
+    times = np.asarray(times, dtype='datetime64[ns]')
+    half_window = np.timedelta64(get_half_window(half_window).value, 'ns')
+    starts = np.searchsorted(times, times - half_window, side='left')
+    ends = np.searchsorted(times, times + half_window, side='right')
+    if statistic == 'max':
+        return _rolling_max(values, starts, ends)
+    if statistic == 'median':
+        return _rolling_quantile(values, starts, ends, 0.5)
+    if statistic == 'quantile':
+        return _rolling_quantile(values, starts, ends, q)
+    raise ValueError(f'Unknown statistic {statistic}')
+
+
+def _rolling_max(values: np.array,
+                 starts: np.array,
+                 ends: np.array) -> np.array:
+    """
+    Max over values[starts[i]:ends[i]], starts and ends being
+    non-decreasing. The deque keeps the indices of the window whose values
+    are decreasing, so that its first index is the max of the window.
+    """
+    result = np.empty(len(values))
+    window = deque()
+    end = 0
+    for i, (start, stop) in enumerate(zip(starts, ends)):
+        while end < stop:
+            while window and values[window[-1]] <= values[end]:
+                window.pop()
+            window.append(end)
+            end += 1
+        while window[0] < start:
+            window.popleft()
+        result[i] = values[window[0]]
+
+    return result
+
+
+def _rolling_quantile(values: np.array,
+                      starts: np.array,
+                      ends: np.array,
+                      q: float) -> np.array:
+    """
+    Quantile (linear interpolation, as np.quantile) over
+    values[starts[i]:ends[i]], starts and ends being non-decreasing.
+    """
+    result = np.empty(len(values))
+    window = []
+    start, end = 0, 0
+    for i, (new_start, stop) in enumerate(zip(starts, ends)):
+        while end < stop:
+            bisect.insort(window, values[end])
+            end += 1
+        while start < new_start:
+            del window[bisect.bisect_left(window, values[start])]
+            start += 1
+        position = q * (len(window) - 1)
+        low = int(position)
+        high = min(low + 1, len(window) - 1)
+        result[i] = (
+            window[low] + (window[high] - window[low]) * (position - low)
+        )
+
+    return result